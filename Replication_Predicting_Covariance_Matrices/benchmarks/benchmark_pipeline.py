@@ -0,0 +1,479 @@
+"""
+Benchmarks of the covariance prediction pipeline on synthetic returns
+
+Times and memory-profiles each stage and checks the numerical agreement of
+the fast paths with their reference implementations, e.g.
+
+    python benchmarks/benchmark_pipeline.py --n 25 100 --T 2000
+    python benchmarks/benchmark_pipeline.py --output after.json --compare before.json
+
+Each row reports its speedup over the first (reference) path of its stage;
+a path slower than the reference is flagged, e.g. the warm started
+regularize_covariance, which only pays off for large n. The references are
+the functions of the baseline revision, see reference_functions.py
+
+Stages whose dense outputs would exceed --max-gb are skipped; the per date
+stages (regularization, EM, Cholesky, combination, likelihood, MSE) run on the last
+--dates time steps only
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import reference_functions as reference  # noqa: E402
+from covariance_functions import backtest_functions  # noqa: E402
+from covariance_functions import em_functions  # noqa: E402
+from covariance_functions.em_functions import from_sigmas  # noqa: E402
+from covariance_functions.ewma_functions import (  # noqa: E402
+    IteratedEWMAState,
+    iterated_ewma,
+    iterated_ewma_tensor,
+)
+from covariance_functions.general_functions import (  # noqa: E402
+    add_to_diagonal,
+    iter_rolling_window,
+    rolling_window,
+)
+from covariance_functions.regularization_functions import (  # noqa: E402
+    em_regularize_covariance,
+    regularize_covariance,
+)
+
+Measurement = namedtuple(
+    "Measurement", ["stage", "path", "n", "T", "seconds", "peak_mb", "error"]
+)
+
+# IEWMA experts of the combination, (vola halflife, cov halflife)
+PAIRS = [(10, 21), (21, 63), (63, 125)]
+
+
+def synthetic_returns(n, T, factors=5, seed=0):
+    """
+    Daily returns of a factor model with slowly varying volatilities
+
+    returns: TxN Frame of returns indexed by business days
+    """
+    rng = np.random.default_rng(seed)
+
+    loadings = rng.standard_normal((n, factors)) / np.sqrt(factors)
+    idiosyncratic = rng.uniform(0.5, 1.5, n)
+
+    # volatility regimes, log volatility follows a random walk
+    vola = np.exp(np.cumsum(rng.standard_normal(T) * 0.02))
+    vola = 0.01 * vola / vola.mean()
+
+    returns = (
+        rng.standard_normal((T, factors)) @ loadings.T
+        + rng.standard_normal((T, n)) * idiosyncratic
+    ) * vola.reshape(-1, 1)
+
+    return pd.DataFrame(
+        returns,
+        index=pd.bdate_range("2000-01-03", periods=T),
+        columns=[f"asset_{i}" for i in range(n)],
+    )
+
+
+def measure(func, memory=True):
+    """
+    Runs func once for its time and, if memory, once more under tracemalloc
+    for its peak memory
+
+    returns: output of func, seconds, peak memory in MB (None if not measured)
+    """
+    start = time.perf_counter()
+    output = func()
+    seconds = time.perf_counter() - start
+
+    peak_mb = None
+    if memory:
+        del output
+        tracemalloc.start()
+        output = func()
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+
+    return output, seconds, peak_mb
+
+
+def relative_error(value, reference_value):
+    """
+    Largest absolute difference relative to the largest absolute reference
+    value, over the entries where both are finite; None if there are none,
+    e.g. when the reference under- or overflows
+    """
+    value = np.asarray(value, dtype=float)
+    reference_value = np.asarray(reference_value, dtype=float)
+    finite = np.isfinite(reference_value) & np.isfinite(value)
+
+    if not finite.any():
+        return None
+
+    return float(
+        np.max(np.abs(value - reference_value)[finite], initial=0)
+        / max(np.max(np.abs(reference_value[finite]), initial=0), 1e-300)
+    )
+
+
+def last_covariances(returns, dates):
+    """
+    The IEWMA covariances of the experts at the last dates time steps,
+    computed online so that only those are kept
+
+    returns: dictionary {key: {time: Sigma}}
+    """
+    sigmas = {}
+    first = len(returns) - dates
+
+    for vola_halflife, cov_halflife in PAIRS:
+        state = IteratedEWMAState(returns.columns, vola_halflife, cov_halflife)
+        sigmas[f"{vola_halflife}-{cov_halflife}"] = {}
+
+        for t, (time_, row) in enumerate(zip(returns.index, returns.values)):
+            iewma = state.update(row, time=time_)
+            if t >= first and iewma is not None:
+                sigmas[f"{vola_halflife}-{cov_halflife}"][time_] = iewma.covariance
+
+    return sigmas
+
+
+def bench_iterated_ewma(returns, args):
+    T, n = returns.shape
+    rows = []
+    reference_value = None
+
+    if _fits(T * n * n, args):
+        dense, seconds, peak = measure(
+            lambda: list(reference.iterated_ewma(returns, *PAIRS[1])), args.memory
+        )
+        reference_value = dense[-1].covariance.values
+        del dense
+        rows.append(("iterated_ewma (reference)", seconds, peak, 0.0))
+
+        dense, seconds, peak = measure(
+            lambda: list(iterated_ewma(returns, *PAIRS[1])), args.memory
+        )
+        last = dense[-1].covariance.values
+        del dense
+        rows.append(("iterated_ewma", seconds, peak, relative_error(last, reference_value)))
+
+    def error(value):
+        if reference_value is None:
+            return None
+        return relative_error(value, reference_value)
+
+    def online():
+        state = IteratedEWMAState.from_returns(returns, *PAIRS[1])
+        return state.estimate.covariance.values
+
+    last, seconds, peak = measure(online, args.memory)
+    rows.append(("IteratedEWMAState", seconds, peak, error(last)))
+
+    if _fits(T * n * (n + 1) // 2, args):
+        tensor, seconds, peak = measure(
+            lambda: iterated_ewma_tensor(returns, *PAIRS[1], packed=True),
+            args.memory,
+        )
+        last = tensor.covariance.take([-1]).dense()[0]
+        rows.append(("iterated_ewma_tensor packed", seconds, peak, error(last)))
+        del tensor
+
+        tensor, seconds, peak = measure(
+            lambda: iterated_ewma_tensor(
+                returns, *PAIRS[1], packed=True, dtype=np.float32
+            ),
+            args.memory,
+        )
+        last = tensor.covariance.take([-1]).dense()[0]
+        rows.append(("iterated_ewma_tensor float32", seconds, peak, error(last)))
+        del tensor
+
+    # only the last day, e.g. for a daily rebalancing
+    tensor, seconds, peak = measure(
+        lambda: iterated_ewma_tensor(returns, *PAIRS[1], times=returns.index[-1:]),
+        args.memory,
+    )
+    rows.append(("iterated_ewma_tensor times", seconds, peak, error(tensor.covariance[-1])))
+
+    return rows
+
+
+def bench_rolling_window(returns, args, memory=250):
+    T, n = returns.shape
+    rows = []
+
+    def streaming():
+        for _, Sigma in iter_rolling_window(returns, memory):
+            pass
+        return Sigma
+
+    last, seconds, peak = measure(streaming, args.memory)
+    error = None
+
+    if _fits(2 * T * n * n, args):
+        Sigmas, seconds_ref, peak_ref = measure(
+            lambda: reference.rolling_window(returns, memory), args.memory
+        )
+        error = relative_error(last, list(Sigmas.values())[-1])
+        del Sigmas
+        rows.append(("reference", seconds_ref, peak_ref, 0.0))
+
+    rows.append(("iter_rolling_window", seconds, peak, error))
+
+    if _fits(T * n * (n + 1) // 2, args):
+        _, seconds, peak = measure(
+            lambda: rolling_window(returns, memory, packed=True), args.memory
+        )
+        rows.append(("rolling_window packed", seconds, peak, error))
+
+        tensor, seconds, peak = measure(
+            lambda: rolling_window(returns, memory, packed=True, dtype=np.float32),
+            args.memory,
+        )
+        if error is not None:
+            error = relative_error(tensor.take([-1]).dense()[0], last)
+        rows.append(("rolling_window float32", seconds, peak, error))
+
+    return rows
+
+
+def bench_regularize_covariance(sigmas, args, rank=5):
+    ref, seconds_ref, peak_ref = measure(
+        lambda: dict(reference.regularize_covariance(sigmas, rank)), args.memory
+    )
+    rows = [("eigh (reference)", seconds_ref, peak_ref, 0.0)]
+
+    for path, warm_start in [("eigh", False), ("warm_start", True)]:
+        fast, seconds, peak = measure(
+            lambda: dict(regularize_covariance(sigmas, rank, warm_start=warm_start)),
+            args.memory,
+        )
+        error = max(relative_error(fast[time], ref[time]) for time in ref)
+        rows.append((path, seconds, peak, error))
+
+    return rows
+
+
+def bench_em_regularize_covariance(sigmas, args, rank=5):
+    initial = dict(regularize_covariance(sigmas, rank, low_rank_format=True))
+
+    def dense(approximation):
+        return approximation.F.values @ approximation.F.values.T + np.diag(
+            approximation.d.values
+        )
+
+    ref, seconds_ref, peak_ref = measure(
+        lambda: dict(reference.em_regularize_covariance(sigmas, initial)),
+        args.memory,
+    )
+    rows = [("reference", seconds_ref, peak_ref, 0.0)]
+
+    for path, kwargs in [
+        ("numpy", dict(initial_sigmas=initial)),
+        ("numpy batch_size=32", dict(initial_sigmas=initial, batch_size=32)),
+    ]:
+        fast, seconds, peak = measure(
+            lambda: dict(em_regularize_covariance(sigmas, **kwargs)), args.memory
+        )
+        error = max(relative_error(dense(fast[time]), dense(ref[time])) for time in ref)
+        rows.append((path, seconds, peak, error))
+
+    return rows
+
+
+def bench_solve(returns, sigmas, args, window=10):
+    sigmas = dict(sigmas)
+    fast = f"{PAIRS[0][0]}-{PAIRS[0][1]}"
+    sigmas[fast] = add_to_diagonal(sigmas[fast], lamda=0.05)
+    def solved(results):
+        return np.array(
+            [result.weights.values for result in results if result is not None]
+        )
+
+    ref, seconds, peak = measure(
+        lambda: list(reference.from_sigmas(sigmas, returns).solve(window=window)),
+        args.memory,
+    )
+    ref = solved(ref)
+    rows = [("cvxpy (reference)", seconds, peak, 0.0)]
+
+    combination = from_sigmas(sigmas, returns)
+    for backend in ["cvxpy", "newton"]:
+        results, seconds, peak = measure(
+            lambda: list(combination.solve(window=window, backend=backend)),
+            args.memory,
+        )
+        rows.append((backend, seconds, peak, relative_error(solved(results), ref)))
+
+    return rows
+
+
+def bench_cholesky_precision(sigmas, args):
+    ref, seconds_ref, peak_ref = measure(
+        lambda: reference._cholesky_precision(sigmas), args.memory
+    )
+    fast, seconds, peak = measure(
+        lambda: em_functions._cholesky_precision(sigmas)[0], args.memory
+    )
+    error = max(relative_error(fast[time], ref[time]) for time in ref)
+
+    return [
+        ("inv/cholesky (reference)", seconds_ref, peak_ref, 0.0),
+        ("chunked cholesky", seconds, peak, error),
+    ]
+
+
+def bench_log_likelihood(returns, sigmas, args):
+    times = list(sigmas)
+    realized = returns.loc[times].values[1:]
+    Sigmas = np.stack([sigmas[time].values for time in times])[:-1]
+
+    # the determinants of the reference underflow for larger n
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ref, seconds_ref, peak_ref = measure(
+            lambda: reference.log_likelihood(realized, Sigmas), args.memory
+        )
+    fast, seconds, peak = measure(
+        lambda: backtest_functions.log_likelihood(realized, Sigmas), args.memory
+    )
+
+    return [
+        ("det/inv (reference)", seconds_ref, peak_ref, 0.0),
+        ("cholesky chunks", seconds, peak, relative_error(fast, ref)),
+    ]
+
+
+def bench_MSE(returns, sigmas, args):
+    ref, seconds_ref, peak_ref = measure(
+        lambda: reference.MSE(returns, sigmas), args.memory
+    )
+    fast, seconds, peak = measure(
+        lambda: backtest_functions.MSE(returns, sigmas), args.memory
+    )
+
+    return [
+        ("loop (reference)", seconds_ref, peak_ref, 0.0),
+        ("vectorized", seconds, peak, relative_error(fast.values, ref.values)),
+    ]
+
+
+def _fits(floats, args):
+    return floats * 8 <= args.max_gb * 1e9
+
+
+def run(n, T, args):
+    returns = synthetic_returns(n, T, seed=args.seed)
+    sigmas = last_covariances(returns, args.dates)
+    expert = sigmas[f"{PAIRS[1][0]}-{PAIRS[1][1]}"]
+
+    stages = {
+        "iterated_ewma": lambda: bench_iterated_ewma(returns, args),
+        "rolling_window": lambda: bench_rolling_window(returns, args),
+        "regularize_covariance": lambda: bench_regularize_covariance(expert, args),
+        "em_regularize_covariance": lambda: bench_em_regularize_covariance(
+            expert, args
+        ),
+        "cholesky_precision": lambda: bench_cholesky_precision(expert, args),
+        "solve": lambda: bench_solve(returns, sigmas, args),
+        "log_likelihood": lambda: bench_log_likelihood(returns, expert, args),
+        "MSE": lambda: bench_MSE(returns, expert, args),
+    }
+
+    measurements = []
+    for stage, bench in stages.items():
+        if args.stages and stage not in args.stages:
+            continue
+        rows = bench()
+        for path, seconds, peak_mb, error in rows:
+            measurement = Measurement(stage, path, n, T, seconds, peak_mb, error)
+            measurements.append(measurement)
+            # the first path of each stage is its reference
+            print(_format(measurement, rows[0][1] / seconds), flush=True)
+
+    return measurements
+
+
+def _format(measurement, speedup):
+    peak = "-" if measurement.peak_mb is None else f"{measurement.peak_mb:10.1f}"
+    error = "-" if measurement.error is None else f"{measurement.error:.1e}"
+    slower = " slower" if speedup < 1 else ""
+    return (
+        f"{measurement.stage:26s} {measurement.path:28s} n={measurement.n:<5d} "
+        f"T={measurement.T:<5d} {measurement.seconds:10.3f}s {peak:>10s}MB "
+        f"err {error:7s} {speedup:6.2f}x{slower}"
+    )
+
+
+def compare(measurements, path):
+    """
+    Prints the speedup of each measurement relative to a previous run
+    """
+    with open(path) as file:
+        previous = {
+            (row["stage"], row["path"], row["n"], row["T"]): row
+            for row in json.load(file)
+        }
+
+    print(f"\nspeedup relative to {path}")
+    for measurement in measurements:
+        row = previous.get(
+            (measurement.stage, measurement.path, measurement.n, measurement.T)
+        )
+        if row is not None:
+            print(
+                f"{measurement.stage:26s} {measurement.path:28s} n={measurement.n:<5d} "
+                f"T={measurement.T:<5d} {row['seconds'] / measurement.seconds:6.2f}x"
+            )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--n", type=int, nargs="+", default=[25, 100, 238, 1000])
+    parser.add_argument("--T", type=int, nargs="+", default=[2000, 5000])
+    parser.add_argument(
+        "--dates", type=int, default=50, help="time steps of the per date stages"
+    )
+    parser.add_argument(
+        "--max-gb", type=float, default=4, help="skip dense outputs above this size"
+    )
+    parser.add_argument("--stages", nargs="+", help="run only these stages")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--no-memory",
+        dest="memory",
+        action="store_false",
+        help="skip the (slower) memory profiling",
+    )
+    parser.add_argument("--output", help="write the measurements to a json file")
+    parser.add_argument("--compare", help="json file of a previous run")
+    args = parser.parse_args(argv)
+
+    measurements = []
+    for T in args.T:
+        for n in args.n:
+            measurements += run(n, T, args)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump([measurement._asdict() for measurement in measurements], file)
+
+    if args.compare:
+        compare(measurements, args.compare)
+
+    return measurements
+
+
+if __name__ == "__main__":
+    main()
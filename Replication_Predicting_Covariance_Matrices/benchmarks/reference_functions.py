@@ -0,0 +1,83 @@
+"""
+Reference implementations the fast paths of covariance_functions are checked
+against in benchmark_pipeline.py: the modules of covariance_functions at the
+BASELINE revision, read with git show when the benchmarks run, so the
+reference is the code the fast paths replaced and cannot drift from it
+
+    import reference_functions as reference
+    reference.iterated_ewma(returns, 63, 125)  # iterated_ewma of BASELINE
+"""
+
+from __future__ import annotations
+
+import functools
+import os
+import subprocess
+import sys
+import types
+
+# the revision before the fast paths
+BASELINE = "3acdfa6"
+
+_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# modules in the order of their imports of each other
+_MODULES = [
+    "general_functions",
+    "regularization_functions",
+    "ewma_functions",
+    "em_functions",
+    "backtest_functions",
+]
+
+# reference function: its module
+_FUNCTIONS = {
+    "rolling_window": "general_functions",
+    "regularize_covariance": "regularization_functions",
+    "em_regularize_covariance": "regularization_functions",
+    "iterated_ewma": "ewma_functions",
+    "_cholesky_precision": "em_functions",
+    "from_sigmas": "em_functions",
+    "MSE": "backtest_functions",
+    "log_likelihood": "backtest_functions",
+}
+
+
+@functools.lru_cache(maxsize=None)
+def load(revision=BASELINE):
+    """
+    Imports covariance_functions at revision as the package
+    baseline_<revision>, next to the covariance_functions of the working tree
+
+    returns: dictionary {module name: module}
+    """
+    package = f"baseline_{revision}"
+    sys.modules[package] = types.ModuleType(package)
+    sys.modules[package].__path__ = []
+
+    modules = {}
+    for name in _MODULES:
+        source = subprocess.run(
+            ["git", "show", f"{revision}:./covariance_functions/{name}.py"],
+            cwd=_FOLDER,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        # the absolute imports of the package would import the working tree
+        source = source.replace("from covariance_functions.", "from .")
+
+        module = types.ModuleType(f"{package}.{name}")
+        module.__package__ = package
+        module.__file__ = f"{revision}:covariance_functions/{name}.py"
+        sys.modules[module.__name__] = module
+        exec(compile(source, module.__file__, "exec"), module.__dict__)
+        modules[name] = module
+
+    return modules
+
+
+def __getattr__(name):
+    if name not in _FUNCTIONS:
+        raise AttributeError(f"no reference implementation of {name}")
+    return getattr(load()[_FUNCTIONS[name]], name)
@@ -1,8 +1,12 @@
 from __future__ import annotations
 
+from collections import namedtuple
+from collections.abc import Mapping
+
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+import scipy as sc
 import os
 import sys
 
@@ -10,56 +14,612 @@ sys.path.append(os.path.abspath(os.path.join(os.getcwd(), '..')))
 
 from covariance_functions.regularization_functions import em_regularize_covariance
 from covariance_functions.regularization_functions import regularize_covariance
+from covariance_functions.regularization_functions import LowRankDiag
+from covariance_functions.general_functions import CovarianceTensor
+from covariance_functions.em_functions import Result
 from covariance_functions.ewma_functions  import ewma
 
-def MSE(returns, covariances):
-    returns_shifted = returns.shift(-1)
+def MSE(returns, covariances, chunk_size=256):
+    """
+    param returns: pandas DataFrame of returns
+    param covariances: dictionary {time: Sigma} or CovarianceTensor, Sigma
+    is a prediction for the next time step
+
+    returns: squared Frobenius norm of Sigma minus the realized outer product
+    of the returns at the next time step
+    """
+    times = _predictor_times(covariances)
+    realized = returns.shift(-1).loc[times].values
 
-    MSEs = []
-    for time, cov in covariances.items():
-        realized_cov = returns_shifted.loc[time].values.reshape(
-            -1, 1
-        ) @ returns_shifted.loc[time].values.reshape(1, -1)
-        MSEs.append(np.linalg.norm(cov - realized_cov) ** 2)
+    MSEs = np.empty(len(times))
+    for start in range(0, len(times), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        x = realized[chunk]
+        Sigmas = _predictor_chunk(covariances, times[chunk])
 
-    return pd.Series(MSEs, index=covariances.keys())
+        MSEs[chunk] = _squared_error(x, Sigmas)
 
-def log_likelihood(returns, Sigmas, means=None, scale=1):
-    """    
+    return pd.Series(MSEs, index=times)
+
+def log_likelihood(
+    returns, Sigmas=None, means=None, scale=1, precision_factors=None, chunk_size=256
+):
+    """
     Computes the log likelihhod assuming Gaussian returns with covariance matrix
     Sigmas and mean vector means
 
     param returns: numpy array where rows are vector of asset returns
-    param Sigmas: numpy array of covariance matrix
+    param Sigmas: numpy array of covariance matrix; or CovarianceTensor; or
+    low rank + diagonal covariance matrices, i.e., LowRankDiag with stacked F
+    (Txnxk) and d (Txn), or a list of LowRankDiag
     param means: numpy array of mean vector; if None, assumes zero mean
-    """    
+    param precision_factors: instead of Sigmas, numpy array of lower
+    triangular L with L @ L.T the inverse of the covariance matrix
+    param chunk_size: number of time steps evaluated at once; bounds the
+    memory of the intermediate arrays
+
+    Note: the determinant and the inverse are never formed; dense covariance
+    matrices are evaluated via their Cholesky factors, low rank + diagonal
+    ones via the Woodbury identity in O(nk^2)
+    """
     if means is None:
         means = np.zeros_like(returns)
 
     T, n = returns.shape
 
-    returns = returns.reshape(T, n, 1)
-    means = means.reshape(T, n, 1)
+    # scaling the returns by scale scales the covariances by scale**2
+    centered = (returns - means) * scale
+
+    if precision_factors is not None:
+        evaluate, Sigmas = _precision_factor_log_likelihood, precision_factors
+    elif isinstance(Sigmas, LowRankDiag) or (
+        isinstance(Sigmas, (list, tuple)) and isinstance(Sigmas[0], LowRankDiag)
+    ):
+        evaluate, Sigmas = _low_rank_log_likelihood, _stack_low_rank(Sigmas)
+    else:
+        evaluate = _dense_log_likelihood
+
+    log_likelihoods = np.empty(T)
+
+    for start in range(0, T, chunk_size):
+        chunk = slice(start, min(start + chunk_size, T))
+        log_likelihoods[chunk] = evaluate(centered[chunk], Sigmas, chunk, scale)
 
-    returns = returns * scale
-    means = means * scale
+    return log_likelihoods - n / 2 * np.log(2 * np.pi)
+
+
+def _dense_log_likelihood(x, Sigmas, chunk, scale):
+    """
+    returns: -1/2 (log det Sigma + x^T Sigma^-1 x) for the time steps in chunk
+
+    param x: chunk of the centered returns
+    param Sigmas: numpy array of covariance matrices or CovarianceTensor
+    """
+    if isinstance(Sigmas, CovarianceTensor):
+        Sigmas = Sigmas.take(chunk).dense()
+    else:
+        Sigmas = np.asarray(Sigmas[chunk])
     Sigmas = Sigmas * scale**2
 
-    dets = np.linalg.det(Sigmas).reshape(len(Sigmas), 1, 1)
-    Sigma_invs = np.linalg.inv(Sigmas)
+    try:
+        chols = np.linalg.cholesky(Sigmas)
+    except np.linalg.LinAlgError:
+        # not positive definite, evaluate via LU
+        sign, logdets = np.linalg.slogdet(Sigmas)
+        quad_forms = np.sum(x * np.linalg.solve(Sigmas, x[..., None])[..., 0], axis=1)
+        return np.where(sign > 0, -1 / 2 * (logdets + quad_forms), np.nan)
 
-    return (
-        -n / 2 * np.log(2 * np.pi)
-        - 1 / 2 * np.log(dets)
-        - 1
-        / 2
-        * np.transpose(returns - means, axes=(0, 2, 1))
-        @ Sigma_invs
-        @ (returns - means)
-    ).flatten()
+    logdets = 2 * np.sum(np.log(np.diagonal(chols, axis1=1, axis2=2)), axis=1)
+    z = sc.linalg.solve_triangular(
+        chols, x[..., None], lower=True, check_finite=False
+    )[..., 0]
+
+    return -1 / 2 * (logdets + np.sum(z**2, axis=1))
+
+
+def _precision_factor_log_likelihood(x, Ls, chunk, scale):
+    """
+    returns: -1/2 (log det Sigma + x^T Sigma^-1 x) for the time steps in chunk
+
+    param x: chunk of the centered returns
+    param Ls: numpy array of the Cholesky factors of the precision matrices
+    """
+    Ls = np.asarray(Ls[chunk]) / scale
+
+    logdets = -2 * np.sum(np.log(np.diagonal(Ls, axis1=1, axis2=2)), axis=1)
+    z = np.swapaxes(Ls, 1, 2) @ x[..., None]
+
+    return -1 / 2 * (logdets + np.sum(z[..., 0] ** 2, axis=1))
+
+
+def _low_rank_log_likelihood(x, Sigmas, chunk, scale):
+    """
+    returns: -1/2 (log det Sigma + x^T Sigma^-1 x) for the time steps in chunk
+
+    param x: chunk of the centered returns
+    param Sigmas: LowRankDiag with stacked F (Txnxk) and d (Txn)
+
+    Note: with Sigma = F F^T + D and M = I + F^T D^-1 F, by Woodbury
+    x^T Sigma^-1 x = x^T D^-1 x - y^T M^-1 y with y = F^T D^-1 x, and
+    log det Sigma = log det D + log det M
+    """
+    F = Sigmas.F[chunk] * scale
+    d = Sigmas.d[chunk] * scale**2
+
+    k = F.shape[2]
+    Ft_Dinv = np.swapaxes(F, 1, 2) / d[:, None, :]
+    M = Ft_Dinv @ F + np.eye(k)
+    y = Ft_Dinv @ x[..., None]
+
+    _, logdets_M = np.linalg.slogdet(M)
+    logdets = np.sum(np.log(d), axis=1) + logdets_M
+    quad_forms = np.sum(x**2 / d, axis=1) - np.sum(
+        y * np.linalg.solve(M, y), axis=(1, 2)
+    )
+
+    return -1 / 2 * (logdets + quad_forms)
+
+
+def _stack_low_rank(Sigmas):
+    """
+    param Sigmas: LowRankDiag or list of LowRankDiag, one per time step
+
+    returns: LowRankDiag with stacked numpy arrays F (Txnxk) and d (Txn)
+    """
+    if isinstance(Sigmas, LowRankDiag):
+        return LowRankDiag(F=np.asarray(Sigmas.F), d=np.asarray(Sigmas.d))
+
+    return LowRankDiag(
+        F=np.stack([np.asarray(Sigma.F) for Sigma in Sigmas]),
+        d=np.stack([np.asarray(Sigma.d) for Sigma in Sigmas]),
+    )
 
 def ecdf(data):
     n = len(data)
     x = np.sort(data)
     y = np.arange(1, n + 1) / n
-    return x, y
\ No newline at end of file
+    return x, y
+
+Evaluation = namedtuple("Evaluation", ["mse", "log_likelihood", "regret", "ecdf"])
+
+
+def evaluate(returns, predictors, freq=None, benchmark=None, chunk_size=256):
+    """
+    Evaluates several covariance predictors in one pass over the returns
+
+    param returns: pandas DataFrame of returns
+    param predictors: dictionary {name: predictor}, where a predictor is a
+    dictionary {time: Sigma} of covariance matrices or of LowRankDiag, or a
+    CovarianceTensor; Sigma at time t is a prediction for the next time step
+    param freq: if given, e.g. "QE" or "YE", all metrics are averaged over
+    these periods
+    param benchmark: name of the predictor the regrets are computed against,
+    e.g. the prescient predictor; if None, the best predictor at each time
+    step
+    param chunk_size: number of time steps evaluated at once
+
+    returns: Evaluation with DataFrames (time x predictor) mse, log_likelihood
+    and regret, indexed by the time of the realized returns; and ecdf, a
+    dictionary {name: (x, y)} of the empirical CDFs of the regrets of all
+    predictors but the benchmark
+
+    Note: only time steps where all predictors are available are evaluated
+    """
+    names = list(predictors)
+
+    # time steps of the predictions with a realized return at the next time step
+    times = returns.index[:-1]
+    for predictor in predictors.values():
+        times = times[times.isin(_predictor_times(predictor))]
+
+    positions = returns.index.get_indexer(times)
+    realized = returns.values[positions + 1]
+    T, n = realized.shape
+
+    mse = np.empty((T, len(names)))
+    log_likelihoods = np.empty((T, len(names)))
+
+    for start in range(0, T, chunk_size):
+        chunk = slice(start, min(start + chunk_size, T))
+        x = realized[chunk]
+
+        for k, name in enumerate(names):
+            Sigmas = _predictor_chunk(predictors[name], times[chunk])
+
+            if isinstance(Sigmas, LowRankDiag):
+                mse[chunk, k] = _low_rank_squared_error(x, Sigmas)
+                log_likelihoods[chunk, k] = _low_rank_log_likelihood(
+                    x, Sigmas, slice(None), 1
+                )
+            else:
+                mse[chunk, k] = _squared_error(x, Sigmas)
+                log_likelihoods[chunk, k] = _dense_log_likelihood(
+                    x, Sigmas, slice(None), 1
+                )
+
+    index = returns.index[positions + 1]
+    mse = pd.DataFrame(mse, index=index, columns=names)
+    log_likelihoods = pd.DataFrame(
+        log_likelihoods - n / 2 * np.log(2 * np.pi), index=index, columns=names
+    )
+
+    if benchmark is None:
+        regret = log_likelihoods.max(axis=1).values.reshape(-1, 1) - log_likelihoods
+    else:
+        regret = log_likelihoods[[benchmark]].values - log_likelihoods
+
+    if freq is not None:
+        mse = mse.resample(freq).mean()
+        log_likelihoods = log_likelihoods.resample(freq).mean()
+        regret = regret.resample(freq).mean()
+
+    return Evaluation(
+        mse=mse,
+        log_likelihood=log_likelihoods,
+        regret=regret,
+        ecdf={
+            name: ecdf(regret[name].dropna().values)
+            for name in names
+            if name != benchmark
+        },
+    )
+
+
+def _predictor_times(predictor):
+    if isinstance(predictor, CovarianceTensor):
+        return predictor.time
+    return pd.Index(list(predictor.keys()))
+
+
+def _predictor_chunk(predictor, times):
+    """
+    returns: the predictions at times as numpy array (len(times)xnxn), or as
+    LowRankDiag with stacked F and d
+    """
+    if isinstance(predictor, CovarianceTensor):
+        return predictor.take(predictor.time.get_indexer(times)).dense()
+
+    Sigmas = [predictor[time] for time in times]
+    if isinstance(Sigmas[0], LowRankDiag):
+        return _stack_low_rank(Sigmas)
+
+    # .values skips the dtype checks of np.asarray on DataFrames
+    return np.stack(
+        [np.asarray(getattr(Sigma, "values", Sigma), dtype=float) for Sigma in Sigmas]
+    )
+
+
+def _squared_error(x, Sigmas):
+    """
+    returns: ||Sigma - x x^T||^2 = ||Sigma||^2 - 2 x^T Sigma x + ||x||^4 for
+    stacked Sigma, without forming the outer products
+    """
+    return (
+        np.sum(Sigmas**2, axis=(1, 2))
+        - 2 * np.einsum("ti,tij,tj->t", x, Sigmas, x)
+        + np.sum(x**2, axis=1) ** 2
+    )
+
+
+def _low_rank_squared_error(x, Sigmas):
+    """
+    returns: ||F F^T + D - x x^T||^2 for stacked F and d, in O(nk^2)
+    """
+    F, d = Sigmas
+    FtF = np.swapaxes(F, 1, 2) @ F
+    Ftx = np.swapaxes(F, 1, 2) @ x[..., None]
+
+    return (
+        np.sum(FtF**2, axis=(1, 2))
+        + 2 * np.sum(d * np.sum(F**2, axis=2), axis=1)
+        + np.sum(d**2, axis=1)
+        - 2 * (np.sum(Ftx**2, axis=(1, 2)) + np.sum(d * x**2, axis=1))
+        + np.sum(x**2, axis=1) ** 2
+    )
+
+
+##### Portfolio backtest #####
+
+PortfolioBacktest = namedtuple(
+    "PortfolioBacktest",
+    ["weights", "returns", "predicted_volatility", "turnover", "statistics"],
+)
+
+# stacked Cholesky factors L (Txnxn) of the precision matrices, L @ L.T = Sigma^-1
+_PrecisionFactors = namedtuple("_PrecisionFactors", ["L"])
+
+
+def portfolio_backtest(
+    returns,
+    predictors,
+    strategies=("min_variance", "risk_parity", "vol_target"),
+    target_volatility=0.1,
+    periods_per_year=252,
+    chunk_size=256,
+    tol=1e-10,
+    max_iter=50,
+):
+    """
+    Backtests portfolios sized by covariance predictions; the weights at time
+    t only use the prediction at time t and are held over the next time step
+
+    param returns: pandas DataFrame of returns
+    param predictors: dictionary {name: predictor}, where a predictor is a
+    dictionary {time: Sigma} of covariance matrices or of LowRankDiag, a
+    CovarianceTensor, or a list of Result, e.g. the output of
+    from_sigmas(...).solve(...); None results are skipped
+    param strategies: any of
+        "min_variance": fully invested minimum variance portfolio,
+            w = Sigma^-1 1 / 1^T Sigma^-1 1
+        "risk_parity": long only portfolio with equal risk contributions
+            w_i (Sigma w)_i, fully invested
+        "vol_target": equal weights scaled to the predicted volatility
+            target_volatility
+    param target_volatility: annualized volatility of "vol_target"
+    param periods_per_year: number of time steps per year, to annualize
+    param chunk_size: number of time steps sized at once
+    param tol: tolerance on the risk contributions of "risk_parity"
+    param max_iter: maximum number of Newton steps of "risk_parity"
+
+    returns: PortfolioBacktest with
+        weights: dictionary {(name, strategy): DataFrame (time x asset)}
+        returns, predicted_volatility, turnover: DataFrames (time x (name,
+        strategy)); returns and turnover are indexed by the time of the
+        realized returns
+        statistics: DataFrame ((name, strategy) x statistic) with the
+        annualized mean, volatility and Sharpe ratio of the returns, the
+        maximum drawdown, the mean turnover and the standard deviation of the
+        returns divided by their predicted volatility (one if the predictor
+        is calibrated)
+
+    Note: each chunk of predictions is factorized at once (batched Cholesky,
+    Woodbury for LowRankDiag, the precision factors of Result), no optimizer
+    is called per time step; missing realized returns count as zero
+    """
+    predictors = {
+        name: _results_to_dict(predictor) for name, predictor in predictors.items()
+    }
+
+    # time steps of the predictions with a realized return at the next time step
+    times = returns.index[:-1]
+    for predictor in predictors.values():
+        times = times[times.isin(_predictor_times(predictor))]
+
+    positions = returns.index.get_indexer(times)
+    realized = np.nan_to_num(returns.values[positions + 1].astype(float))
+    T, n = realized.shape
+
+    columns = [(name, strategy) for name in predictors for strategy in strategies]
+    weights = {column: np.empty((T, n)) for column in columns}
+    volatilities = np.empty((T, len(columns)))
+
+    target = target_volatility / np.sqrt(periods_per_year)
+
+    # covariance predictions that are not positive definite give NaN weights
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for start in range(0, T, chunk_size):
+            chunk = slice(start, min(start + chunk_size, T))
+
+            for name in predictors:
+                Sigmas = _portfolio_chunk(predictors[name], times[chunk])
+
+                for strategy in strategies:
+                    if strategy == "min_variance":
+                        w = _min_variance_weights(Sigmas)
+                    elif strategy == "risk_parity":
+                        w = _risk_parity_weights(Sigmas, tol=tol, max_iter=max_iter)
+                    elif strategy == "vol_target":
+                        w = np.full(realized[chunk].shape, 1 / n)
+                        w *= target / np.sqrt(_quad_form(Sigmas, w))[:, None]
+                    else:
+                        raise ValueError(f"unknown strategy {strategy}")
+
+                    k = columns.index((name, strategy))
+                    weights[(name, strategy)][chunk] = w
+                    volatilities[chunk, k] = np.sqrt(_quad_form(Sigmas, w))
+
+    portfolio_returns = np.stack(
+        [np.sum(weights[column] * realized, axis=1) for column in columns], axis=1
+    )
+    turnover = np.stack(
+        [
+            np.r_[np.nan, np.sum(np.abs(np.diff(weights[column], axis=0)), axis=1)]
+            for column in columns
+        ],
+        axis=1,
+    )
+
+    index = returns.index[positions + 1]
+    columns_index = pd.MultiIndex.from_tuples(columns, names=["predictor", "strategy"])
+
+    portfolio_returns = pd.DataFrame(portfolio_returns, index=index, columns=columns_index)
+    turnover = pd.DataFrame(turnover, index=index, columns=columns_index)
+    volatilities = pd.DataFrame(volatilities, index=times, columns=columns_index)
+
+    wealth = (1 + portfolio_returns).cumprod()
+    statistics = pd.DataFrame(
+        {
+            "mean": portfolio_returns.mean() * periods_per_year,
+            "volatility": portfolio_returns.std() * np.sqrt(periods_per_year),
+            "max_drawdown": (1 - wealth / wealth.cummax()).max(),
+            "turnover": turnover.mean(),
+            "risk_ratio": (portfolio_returns / volatilities.values).std(),
+        }
+    )
+    statistics.insert(2, "sharpe", statistics["mean"] / statistics["volatility"])
+
+    return PortfolioBacktest(
+        weights={
+            column: pd.DataFrame(weights[column], index=times, columns=returns.columns)
+            for column in columns
+        },
+        returns=portfolio_returns,
+        predicted_volatility=volatilities,
+        turnover=turnover,
+        statistics=statistics,
+    )
+
+
+def _results_to_dict(predictor):
+    """
+    returns: a list of Result as dictionary {time: Result}, any other
+    predictor as is
+    """
+    if isinstance(predictor, (list, tuple)):
+        return {result.time: result for result in predictor if result is not None}
+    return predictor
+
+
+def _portfolio_chunk(predictor, times):
+    """
+    returns: the predictions at times as numpy array (len(times)xnxn), as
+    LowRankDiag with stacked F and d, or as _PrecisionFactors
+    """
+    if isinstance(predictor, Mapping) and isinstance(
+        predictor[times[0]], Result
+    ):
+        return _PrecisionFactors(L=np.stack([predictor[time].L for time in times]))
+    return _predictor_chunk(predictor, times)
+
+
+def _solve_stacked(Sigmas, b):
+    """
+    returns: Sigma^-1 b for stacked Sigmas and vectors b (Txn)
+    """
+    if isinstance(Sigmas, _PrecisionFactors):
+        L = Sigmas.L
+        return (L @ (np.swapaxes(L, 1, 2) @ b[..., None]))[..., 0]
+
+    if isinstance(Sigmas, LowRankDiag):
+        # Woodbury, see _low_rank_log_likelihood
+        F, d = Sigmas
+        Ft_Dinv = np.swapaxes(F, 1, 2) / d[:, None, :]
+        M = Ft_Dinv @ F + np.eye(F.shape[2])
+        y = np.linalg.solve(M, Ft_Dinv @ b[..., None])
+        return b / d - (np.swapaxes(Ft_Dinv, 1, 2) @ y)[..., 0]
+
+    try:
+        chols = np.linalg.cholesky(Sigmas)
+    except np.linalg.LinAlgError:
+        # not positive definite, solve via LU
+        return _solve_each(Sigmas, b)
+
+    # Sigma^-1 = C^-T C^-1
+    z = sc.linalg.solve_triangular(chols, b[..., None], lower=True, check_finite=False)
+    return sc.linalg.solve_triangular(
+        chols, z, lower=True, trans="T", check_finite=False
+    )[..., 0]
+
+
+def _solve_each(A, b):
+    """
+    returns: A^-1 b for stacked A and b (Txn), NaN for singular A
+    """
+    try:
+        return np.linalg.solve(A, b[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        x = np.full(b.shape, np.nan)
+        for t in range(len(b)):
+            try:
+                x[t] = np.linalg.solve(A[t], b[t])
+            except np.linalg.LinAlgError:
+                pass
+        return x
+
+
+def _multiply_stacked(Sigmas, w):
+    """
+    returns: Sigma w for stacked Sigmas and vectors w (Txn)
+    """
+    if isinstance(Sigmas, _PrecisionFactors):
+        # Sigma = L^-T L^-1
+        L = Sigmas.L
+        z = sc.linalg.solve_triangular(L, w[..., None], lower=True, check_finite=False)
+        return sc.linalg.solve_triangular(
+            L, z, lower=True, trans="T", check_finite=False
+        )[..., 0]
+
+    if isinstance(Sigmas, LowRankDiag):
+        F, d = Sigmas
+        return (F @ (np.swapaxes(F, 1, 2) @ w[..., None]))[..., 0] + d * w
+
+    return (Sigmas @ w[..., None])[..., 0]
+
+
+def _quad_form(Sigmas, w):
+    """
+    returns: w^T Sigma w for stacked Sigmas and vectors w (Txn)
+    """
+    return np.sum(w * _multiply_stacked(Sigmas, w), axis=1)
+
+
+def _min_variance_weights(Sigmas):
+    ones = np.ones(_stacked_shape(Sigmas))
+    w = _solve_stacked(Sigmas, ones)
+    return w / np.sum(w, axis=1, keepdims=True)
+
+
+def _risk_parity_weights(Sigmas, tol=1e-10, max_iter=50):
+    """
+    Long only equal risk contribution weights, via damped Newton steps on the
+    convex problem  minimize 1/2 y^T Sigma y - 1/n sum_i log y_i,  whose
+    solution satisfies y_i (Sigma y)_i = 1/n; all time steps are iterated at
+    once and w = y / sum(y)
+
+    Note: the Newton system Sigma + diag(1/(n y^2)) keeps the structure of
+    Sigma, hence LowRankDiag is solved via Woodbury; precision factors are
+    inverted once
+    """
+    T, n = _stacked_shape(Sigmas)
+
+    if isinstance(Sigmas, _PrecisionFactors):
+        Linv = sc.linalg.solve_triangular(
+            Sigmas.L,
+            np.broadcast_to(np.eye(n), Sigmas.L.shape),
+            lower=True,
+            check_finite=False,
+        )
+        Sigmas = np.swapaxes(Linv, 1, 2) @ Linv
+
+    # start from inverse volatility weights, scaled to unit variance
+    variances = (
+        np.sum(Sigmas.F**2, axis=2) + Sigmas.d
+        if isinstance(Sigmas, LowRankDiag)
+        else np.diagonal(Sigmas, axis1=1, axis2=2)
+    )
+    y = 1 / np.sqrt(variances)
+    y /= np.sqrt(_quad_form(Sigmas, y))[:, None]
+
+    for _ in range(max_iter):
+        Sigma_y = _multiply_stacked(Sigmas, y)
+        gradient = Sigma_y - 1 / (n * y)
+        if not np.nanmax(np.abs(y * gradient), initial=0) >= tol:
+            break
+
+        curvature = 1 / (n * y**2)
+        if isinstance(Sigmas, LowRankDiag):
+            step = _solve_stacked(
+                LowRankDiag(F=Sigmas.F, d=Sigmas.d + curvature), gradient
+            )
+        else:
+            hessian = Sigmas + curvature[:, :, None] * np.eye(n)
+            step = _solve_each(hessian, gradient)
+
+        # largest step in (0, 1] that keeps y positive
+        with np.errstate(divide="ignore"):
+            bound = np.where(step > 0, 0.9 * y / step, np.inf).min(axis=1)
+        # time steps without a solution stay NaN
+        y = y - np.minimum(1, bound)[:, None] * step
+
+    return y / np.sum(y, axis=1, keepdims=True)
+
+
+def _stacked_shape(Sigmas):
+    """
+    returns: (number of time steps, number of assets)
+    """
+    if isinstance(Sigmas, _PrecisionFactors):
+        return Sigmas.L.shape[:2]
+    if isinstance(Sigmas, LowRankDiag):
+        return Sigmas.d.shape
+    return Sigmas.shape[:2]
@@ -0,0 +1,414 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from .em_functions import Result, from_sigmas
+from .ewma_functions import IEWMA, IEWMATensor, IteratedEWMAState, iterated_ewma_tensor
+from .general_functions import CovarianceTensor, rolling_window
+from .storage_functions import StoreWriter, open_store, write_covariances, write_vectors
+
+
+class ResultCache:
+    def __init__(self, directory, max_bytes=2**30):
+        """
+        On-disk memoization of expert covariance runs; each result is keyed on
+        a hash of its inputs and all its parameters, hence running the same
+        analysis again on unchanged returns only reads from disk
+
+        param directory: folder of the cache, created if needed
+        param max_bytes: the least recently used results are removed once the
+        cache is larger than this
+
+        Covariance matrices are stored as packed stores, see storage_functions
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def iterated_ewma(self, returns, vola_halflife, cov_halflife, **kwargs):
+        """
+        Cached iterated_ewma(returns, vola_halflife, cov_halflife, **kwargs);
+        as iterated_ewma, a view on the cached tensor that only wraps the time
+        steps into pandas objects when they are requested
+        """
+        tensor = self.iterated_ewma_tensor(returns, vola_halflife, cov_halflife, **kwargs)
+
+        assets = tensor.assets
+        for k, time in enumerate(tensor.time):
+            yield IEWMA(
+                time=time,
+                mean=pd.Series(tensor.mean[k], index=assets),
+                covariance=tensor.covariance[time],
+                volatility=pd.Series(tensor.volatility[k], index=assets, name=time),
+            )
+
+    def iterated_ewma_tensor(self, returns, vola_halflife, cov_halflife, **kwargs):
+        """
+        Cached iterated_ewma_tensor(returns, vola_halflife, cov_halflife,
+        packed=True, **kwargs), whatever packed is passed; the covariance,
+        mean and volatility arrays are memory mapped from the stores of the
+        cache
+
+        Each run is saved with its final IteratedEWMAState. When the cache
+        holds the same run on the first rows of returns, e.g. before new
+        returns were appended, only the new rows are computed, starting from
+        that state; runs at requested times (times=...) are keyed on the
+        times, but are not extended
+        """
+        # the cache stores packed tensors; times=None is the run on all rows
+        kwargs.pop("packed", None)
+        times = kwargs.pop("times", None)
+        requested = times is not None
+
+        # params are the ones of the IteratedEWMAState of the run
+        params = dict(vola_halflife=vola_halflife, cov_halflife=cov_halflife, **kwargs)
+        kind = f"iewma-{_digest(dict(params, times=times) if requested else params)}"
+        entry = self._entry(kind, returns)
+
+        if not os.path.exists(entry):
+            prefix = None if requested else self._longest_prefix(kind, returns)
+
+            if prefix is None:
+                tensor = iterated_ewma_tensor(returns, **params, packed=True, times=times)
+                self._write(
+                    entry,
+                    rows=len(returns),
+                    covariances=tensor.covariance,
+                    vectors={"mean": tensor.mean, "volatility": tensor.volatility},
+                    # the last requested time need not be the last row
+                    state=None
+                    if requested
+                    else IteratedEWMAState._from_tensor(returns, tensor, **params),
+                )
+            else:
+                self._extend(entry, returns, prefix)
+                # the extended run replaces the run on the prefix
+                shutil.rmtree(prefix, ignore_errors=True)
+
+        covariance, vectors = self._read(entry)
+
+        return IEWMATensor(
+            time=covariance.time,
+            assets=covariance.assets,
+            mean=vectors["mean"].values,
+            covariance=covariance,
+            volatility=vectors["volatility"].values,
+        )
+
+    def rolling_window(self, returns, memory, min_periods=20):
+        """
+        Cached rolling_window(returns, memory, min_periods, packed=True), memory
+        mapped from the cache
+        """
+        params = dict(memory=memory, min_periods=min_periods)
+        entry = self._entry(f"rw-{_digest(params)}", returns)
+
+        if not os.path.exists(entry):
+            tensor = rolling_window(returns, packed=True, **params)
+            self._write(entry, rows=len(returns), covariances=tensor)
+
+        covariance, _ = self._read(entry)
+        return covariance
+
+    def solve(self, sigmas, returns, means=None, **kwargs):
+        """
+        Cached list(from_sigmas(sigmas, returns, means).solve(**kwargs)); the
+        key includes all covariance matrices and means
+        """
+        hasher = _hasher(returns)
+        for key, sigma in sigmas.items():
+            hasher.update(key.encode())
+            _update(hasher, sigma)
+            if means is not None:
+                _update(hasher, means[key])
+
+        kind = f"solve-{_digest({key: str(value) for key, value in kwargs.items()})}"
+        entry = os.path.join(self.directory, f"{kind}-{hasher.hexdigest()[:32]}")
+
+        if not os.path.exists(entry):
+            results = list(from_sigmas(sigmas, returns, means).solve(**kwargs))
+            self._write_results(entry, results, keys=list(sigmas), assets=returns.columns)
+
+        return self._read_results(entry)
+
+    @property
+    def size(self):
+        """
+        Number of bytes of all cached results
+        """
+        return sum(size for _, size, _ in self._entries())
+
+    def clear(self):
+        for entry, _, _ in self._entries():
+            shutil.rmtree(entry, ignore_errors=True)
+
+    def _entry(self, kind, returns):
+        return os.path.join(self.directory, f"{kind}-{_hasher(returns).hexdigest()[:32]}")
+
+    def _entries(self):
+        """
+        returns: list of (folder, bytes, last access) of all cached results
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            entry = os.path.join(self.directory, name)
+            meta = os.path.join(entry, "meta.json")
+            if os.path.isdir(entry) and os.path.exists(meta):
+                size = sum(
+                    os.path.getsize(os.path.join(entry, file))
+                    for file in os.listdir(entry)
+                )
+                entries.append((entry, size, os.path.getmtime(meta)))
+        return entries
+
+    def _longest_prefix(self, kind, returns):
+        """
+        returns: the folder of the run of kind on the most first rows of
+        returns, None if there is none
+        """
+        best, best_rows = None, 0
+
+        for entry, _, _ in self._entries():
+            if not os.path.basename(entry).startswith(kind + "-"):
+                continue
+            with open(os.path.join(entry, "meta.json")) as file:
+                rows = json.load(file)["rows"]
+            if best_rows < rows < len(returns) and os.path.basename(
+                entry
+            ) == os.path.basename(self._entry(kind, returns.iloc[:rows])):
+                best, best_rows = entry, rows
+
+        return best
+
+    def _extend(self, entry, returns, prefix):
+        """
+        Continues the IEWMA run in prefix on the remaining rows of returns from
+        its saved state, and streams the estimates of prefix and of the new
+        rows into entry
+        """
+        assets = returns.columns
+        upper = np.triu_indices(len(assets))
+
+        with open(os.path.join(prefix, "meta.json")) as file:
+            rows = json.load(file)["rows"]
+        state = IteratedEWMAState.load(os.path.join(prefix, "state.npz"))
+        previous, previous_vectors = self._read(prefix)
+
+        temporary = f"{entry}.{os.getpid()}.tmp"
+        os.makedirs(temporary, exist_ok=True)
+
+        def writer(name, layout):
+            return StoreWriter(
+                os.path.join(temporary, f"{name}.store"),
+                columns=assets,
+                layout=layout,
+                dtype=state.params["dtype"],
+            )
+
+        with writer("covariance", "packed") as covariance, writer(
+            "mean", "vector"
+        ) as mean, writer("volatility", "vector") as volatility:
+            covariance.write(zip(previous.time, previous.packed))
+            for name, store in (("mean", mean), ("volatility", volatility)):
+                store.write(
+                    zip(previous_vectors[name].time, previous_vectors[name].values)
+                )
+
+            for time, row in zip(returns.index[rows:], returns.values[rows:]):
+                if state._update(row, time=time):
+                    m, cov, vola = state._arrays()
+                    covariance.append(time, cov[upper])
+                    mean.append(time, m)
+                    volatility.append(time, vola)
+
+        state.save(os.path.join(temporary, "state.npz"))
+        _write_meta(temporary, rows=len(returns), vectors=["mean", "volatility"])
+
+        self._commit(temporary, entry)
+
+    def _write(self, entry, rows, covariances, vectors=None, state=None):
+        """
+        Writes a result to a temporary folder, then moves it to entry
+
+        param covariances: CovarianceTensor
+        param vectors: dictionary {name: Txn array} aligned with covariances
+        """
+        temporary = f"{entry}.{os.getpid()}.tmp"
+        os.makedirs(temporary, exist_ok=True)
+
+        write_covariances(os.path.join(temporary, "covariance.store"), covariances)
+        for name, values in (vectors or {}).items():
+            write_vectors(
+                os.path.join(temporary, f"{name}.store"),
+                zip(covariances.time, values),
+                columns=covariances.assets,
+                dtype=values.dtype,
+            )
+        if state is not None:
+            state.save(os.path.join(temporary, "state.npz"))
+        _write_meta(temporary, rows=rows, vectors=list(vectors or {}))
+
+        self._commit(temporary, entry)
+
+    def _read(self, entry):
+        """
+        returns: the CovarianceTensor and a dictionary of the VectorStores of
+        the result in entry; marks it as recently used
+        """
+        meta = os.path.join(entry, "meta.json")
+        os.utime(meta)
+        with open(meta) as file:
+            names = json.load(file)["vectors"]
+
+        covariance = open_store(os.path.join(entry, "covariance.store"))
+        vectors = {name: open_store(os.path.join(entry, f"{name}.store")) for name in names}
+        return covariance, vectors
+
+    def _write_results(self, entry, results, keys, assets):
+        temporary = f"{entry}.{os.getpid()}.tmp"
+        os.makedirs(temporary, exist_ok=True)
+
+        solved = [result for result in results if result is not None]
+        n, K = len(assets), len(keys)
+
+        np.savez(
+            os.path.join(temporary, "results.npz"),
+            solved=np.array([result is not None for result in results], dtype=bool),
+            time=np.asarray(
+                pd.DatetimeIndex([result.time for result in solved]), dtype="datetime64[ns]"
+            ).view("<i8"),
+            L=np.array([result.L for result in solved]).reshape(len(solved), n, n),
+            nu=np.array([result.nu for result in solved]).reshape(len(solved), n),
+            weights=np.array([result.weights.values for result in solved]).reshape(
+                len(solved), K
+            ),
+            status=np.array([str(result.status) for result in solved], dtype=str),
+            iterations=np.array(
+                [-1 if result.iterations is None else result.iterations for result in solved],
+                dtype=np.int64,
+            ),
+        )
+        with open(os.path.join(temporary, "meta.json"), "w") as file:
+            json.dump({"keys": keys, "assets": [str(asset) for asset in assets]}, file)
+
+        self._commit(temporary, entry)
+
+    def _read_results(self, entry):
+        meta = os.path.join(entry, "meta.json")
+        os.utime(meta)
+        with open(meta) as file:
+            meta = json.load(file)
+
+        with np.load(os.path.join(entry, "results.npz")) as data:
+            data = dict(data)
+
+        solved = iter(
+            Result(
+                time=time,
+                L=L,
+                nu=nu,
+                weights=pd.Series(weights, index=meta["keys"]),
+                assets=pd.Index(meta["assets"]),
+                status=str(status),
+                iterations=None if iterations < 0 else int(iterations),
+            )
+            for time, L, nu, weights, status, iterations in zip(
+                pd.DatetimeIndex(data["time"].view("datetime64[ns]")),
+                data["L"],
+                data["nu"],
+                data["weights"],
+                data["status"],
+                data["iterations"],
+            )
+        )
+        return [next(solved) if ok else None for ok in data["solved"]]
+
+    def _commit(self, temporary, entry):
+        """
+        Moves a written result into place and removes the least recently used
+        results while the cache is too large
+        """
+        if os.path.exists(entry):
+            shutil.rmtree(temporary, ignore_errors=True)
+        else:
+            os.replace(temporary, entry)
+
+        entries = sorted(self._entries(), key=lambda item: item[2])
+        total = sum(size for _, size, _ in entries)
+
+        for old, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if old != entry:
+                shutil.rmtree(old, ignore_errors=True)
+                total -= size
+
+
+def _hasher(frame):
+    """
+    returns: sha256 hasher updated with the index, the columns and the values
+    of frame
+    """
+    hasher = hashlib.sha256()
+    _update(hasher, frame)
+    return hasher
+
+
+def _update(hasher, data):
+    """
+    Updates hasher with a DataFrame, a Series, a CovarianceTensor, a
+    dictionary {time: matrix} or an array
+    """
+    if isinstance(data, CovarianceTensor):
+        hasher.update(np.asarray(data.time, dtype="datetime64[ns]").tobytes())
+        hasher.update(json.dumps([str(asset) for asset in data.assets]).encode())
+        hasher.update(np.ascontiguousarray(data.packed).tobytes())
+    elif isinstance(data, (pd.DataFrame, pd.Series)):
+        hasher.update(json.dumps([str(label) for label in data.index]).encode())
+        if isinstance(data, pd.DataFrame):
+            hasher.update(json.dumps([str(column) for column in data.columns]).encode())
+        hasher.update(np.ascontiguousarray(data.values, dtype=float).tobytes())
+    elif isinstance(data, dict):
+        for key, value in data.items():
+            hasher.update(str(key).encode())
+            _update(hasher, value)
+    else:
+        hasher.update(np.ascontiguousarray(data, dtype=float).tobytes())
+
+
+def _write_meta(folder, rows, vectors):
+    with open(os.path.join(folder, "meta.json"), "w") as file:
+        json.dump({"rows": rows, "vectors": vectors}, file)
+
+
+def _digest(params):
+    return hashlib.sha256(
+        json.dumps(params, sort_keys=True, default=_parameter).encode()
+    ).hexdigest()[:16]
+
+
+def _parameter(value):
+    """
+    JSON representation of the parameters json does not handle natively
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.dtype) or (
+        isinstance(value, type) and issubclass(value, np.generic)
+    ):
+        # e.g. dtype=np.float32
+        return np.dtype(value).name
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    if isinstance(value, (pd.Index, pd.Series, np.ndarray)):
+        # e.g. times=..., keyed on a hash of the values
+        return hashlib.sha256(
+            json.dumps([str(item) for item in pd.Index(value)]).encode()
+        ).hexdigest()
+    raise TypeError(f"the cache does not support the parameter {value!r}")
@@ -0,0 +1,217 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+# the data folder of the repository
+DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data"))
+
+# bump to invalidate all caches when the parsing changes
+_CACHE_VERSION = 1
+
+Dataset = namedtuple("Dataset", ["file", "layout", "options"])
+
+DATASETS = {
+    # wide files, one column per asset (or factor), one row per date
+    "sp500_top25": Dataset("SP500_top25_adjusted.csv", "wide", {}),
+    "returns": Dataset("returns_data.csv", "wide", {}),
+    "large_universe": Dataset("returns_large_universe.csv", "wide", {}),
+    "industries": Dataset("49_industries.csv", "wide", {}),
+    "etf": Dataset("ETF_data.csv", "wide", {}),
+    "ff5": Dataset("ff5.csv", "wide", {}),
+    "ff5_no_rf": Dataset("ff5_no_rf.csv", "wide", {}),
+    # ff5 without RF and momentum, short and long term reversal
+    "factors": Dataset("factor_data.csv", "wide", {}),
+    # Kenneth French daily files, in percent
+    "momentum": Dataset("momentum.CSV", "wide", {"format": "%Y%m%d", "scale": 0.01}),
+    "st_reversal": Dataset(
+        "st_reversal.csv", "wide", {"format": "%Y%m%d", "scale": 0.01}
+    ),
+    "lt_reversal": Dataset(
+        "lt_reversal.csv", "wide", {"format": "%Y%m%d", "scale": 0.01}
+    ),
+    "vix": Dataset("vix.csv", "wide", {"format": None}),
+    # long CRSP files with columns PERMNO, date, TICKER, COMNAM, RET, RETX
+    "reit": Dataset(
+        "REIT_data.csv", "crsp", {"value": "RET", "format": "%m/%d/%y", "dropna": True}
+    ),
+    "commodities": Dataset("commod_etf.csv", "crsp", {"value": "RETX"}),
+    "private_equity": Dataset("pe_firm_etf.csv", "crsp", {"value": "RETX"}),
+}
+
+Frame = namedtuple("Frame", ["time", "columns", "values"])
+
+
+def load(
+    name,
+    assets=None,
+    start=None,
+    end=None,
+    tickers=False,
+    as_array=False,
+    data_dir=None,
+    cache_dir=None,
+):
+    """
+    Loads a dataset of the data folder as a wide frame (time x asset); the
+    parsed frame is cached in binary form and only parsed again when the
+    source file changes (modification time or size)
+
+    param name: a key of DATASETS, e.g. "sp500_top25", "reit" or "ff5"; or the
+    name of a wide csv file in data_dir
+    param assets: columns to return (optional), after the ticker mapping
+    param start: first date to return (optional)
+    param end: last date to return (optional)
+    param tickers: if True, PERMNO columns are renamed to tickers with
+    permno_to_ticker_mapping.csv
+    param as_array: if True, returns a Frame namedtuple (time, columns,
+    values) with a numpy array of values instead of a DataFrame
+    param data_dir: folder of the csv files; defaults to DATA_DIR
+    param cache_dir: folder of the cache; defaults to data_dir/.cache
+    """
+    data_dir = data_dir or DATA_DIR
+    cache_dir = cache_dir or os.path.join(data_dir, ".cache")
+    dataset = DATASETS.get(name, Dataset(name, "wide", {}))
+
+    frame = _cached(
+        os.path.join(data_dir, dataset.file),
+        cache_dir,
+        parser=_PARSERS[dataset.layout],
+        options=dataset.options,
+    )
+
+    if tickers:
+        frame = frame.rename(columns=permno_to_ticker(data_dir, cache_dir))
+    if start is not None or end is not None:
+        frame = frame.loc[start:end]
+    if assets is not None:
+        frame = frame.loc[:, list(assets)]
+
+    if as_array:
+        return Frame(time=frame.index, columns=frame.columns, values=frame.values)
+    return frame
+
+
+def permno_to_ticker(data_dir=None, cache_dir=None):
+    """
+    returns: dictionary {PERMNO (as string): ticker}
+    """
+    data_dir = data_dir or DATA_DIR
+    cache_dir = cache_dir or os.path.join(data_dir, ".cache")
+    path = os.path.join(data_dir, "permno_to_ticker_mapping.csv")
+
+    def parse(path):
+        mapping = pd.read_csv(path)
+        return pd.DataFrame(
+            {"tic": mapping["tic"].astype(str).values},
+            index=pd.Index(mapping["PERMNO"].astype(str).values),
+        )
+
+    mapping = _cached(path, cache_dir, parser=parse, options={}, index="object")
+    # later rows overwrite earlier ones for the same PERMNO
+    return dict(zip(mapping.index, mapping["tic"]))
+
+
+def _read_wide(path, format="%Y-%m-%d", scale=None):
+    """
+    Wide csv with the dates in the first column; the values are multiplied by
+    scale if given, e.g. 0.01 for returns in percent
+    """
+    frame = pd.read_csv(path, index_col=0)
+    frame.index = pd.to_datetime(frame.index.astype(str), format=format)
+    if scale is not None:
+        frame = frame * scale
+    frame.columns = frame.columns.astype(str)
+    return frame.rename_axis("Date", axis="index")
+
+
+def _read_crsp(path, value="RET", format="%Y-%m-%d", dropna=False):
+    """
+    Long CRSP csv, pivoted to one column per ticker; non numeric returns, e.g.
+    "C" or "B", are set to NaN
+    """
+    frame = pd.read_csv(path)
+    frame["RETX"] = pd.to_numeric(frame["RETX"], errors="coerce")
+    frame["RET"] = pd.to_numeric(frame["RET"], errors="coerce")
+    frame["date"] = pd.to_datetime(frame["date"], format=format)
+
+    if dropna:
+        frame = frame.dropna()
+
+    frame = frame.pivot(index="date", columns="TICKER", values=value)
+    frame.columns = frame.columns.astype(str)
+    return frame.rename_axis("Date", axis="index").rename_axis(None, axis="columns")
+
+
+_PARSERS = {"wide": _read_wide, "crsp": _read_crsp}
+
+
+def _cached(path, cache_dir, parser, options, index="datetime"):
+    """
+    Returns parser(path, **options), from the cache if the source file has
+    not changed since it was cached
+
+    The cache stores the values as one float array and the index and columns
+    separately, hence loading it does not parse any text
+    """
+    stat = os.stat(path)
+    key = {
+        "version": _CACHE_VERSION,
+        "path": os.path.abspath(path),
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "parser": parser.__name__,
+        "options": options,
+    }
+    digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+    cache = os.path.join(cache_dir, f"{os.path.basename(path)}.{digest}.npz")
+
+    if os.path.exists(cache):
+        with np.load(cache, allow_pickle=False) as stored:
+            if json.loads(str(stored["key"])) == key:
+                if index == "datetime":
+                    time = pd.DatetimeIndex(
+                        stored["index"].view("datetime64[ns]"), name=str(stored["name"])
+                    )
+                else:
+                    time = pd.Index(stored["index"].astype(str))
+                return pd.DataFrame(
+                    stored["values"], index=time, columns=stored["columns"].astype(str)
+                )
+
+    frame = parser(path, **options)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    for stale in os.listdir(cache_dir):
+        # older caches of the same file
+        if stale.startswith(os.path.basename(path) + ".") and stale.endswith(".npz"):
+            os.remove(os.path.join(cache_dir, stale))
+
+    if index == "datetime":
+        stored_index = np.asarray(frame.index, dtype="datetime64[ns]").view("<i8")
+    else:
+        stored_index = np.asarray(frame.index, dtype=str)
+
+    values = frame.values
+    if values.dtype == object:
+        values = values.astype(str)
+
+    # write to a temporary file first, a concurrent reader never sees a
+    # partial cache
+    temporary = cache + f".{os.getpid()}.tmp.npz"
+    np.savez(
+        temporary,
+        key=json.dumps(key),
+        values=values,
+        index=stored_index,
+        name=str(frame.index.name),
+        columns=np.asarray(frame.columns, dtype=str),
+    )
+    os.replace(temporary, cache)
+
+    return frame
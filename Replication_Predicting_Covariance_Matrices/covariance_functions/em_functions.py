@@ -1,82 +1,202 @@
 from __future__ import annotations
 
 import warnings
-from collections import namedtuple
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
 
 import cvxpy as cvx
 import numpy as np
 import pandas as pd
+import scipy as sc
 
-from .ewma_functions import iterated_ewma
+from . import instrumentation_functions as instrumentation
+from .ewma_functions import iterated_ewma_tensors
+from .general_functions import CovarianceTensor
 
 # Mute specific warning
 warnings.filterwarnings("ignore", message="Solution may be inaccurate.*")
 
 
-def _map_nested_dicts(ob, func):
+def _cholesky_precision(cov, chunk_size=256):
     """
-    Recursively applies a function to a nested dictionary
-    """
-    if isinstance(ob, dict):
-        return {k: _map_nested_dicts(v, func) for k, v in ob.items()}
+    Computes Cholesky factor of the inverse of each covariance matrix in cov
 
-    return func(ob)
+    param cov: dictionary of covariance matrices {time: Sigma}, or
+    CovarianceTensor
+    param chunk_size: number of time steps unpacked and factorized at once;
+    bounds the memory of the intermediate arrays
 
+    returns: dictionary {time: L} with L @ L.T the inverse of Sigma, for all
+    time steps where Sigma is positive definite; and boolean Series indexed by
+    time, True where the factorization failed
 
-def _cholesky_precision(cov):
+    Note: with J the matrix reversing the order of the assets and C the
+    Cholesky factor of J Sigma J, the inverse of Sigma is (J C^-T J)(J C^-T J)^T
+    and J C^-T J is lower triangular; hence the factors are obtained with one
+    batched Cholesky and a triangular solve per time step, without inverting
+    Sigma. The factors are views into a single (T, n, n) array
     """
-    Computes Cholesky factor of the inverse of each covariance matrix in cov
+    times = list(cov.keys())
+    n = cov.n if isinstance(cov, CovarianceTensor) else np.shape(cov[times[0]])[0]
 
-    param cov: dictionary of covariance matrices {time: Sigma}
-    """
-    result = {}
+    Ls = np.empty((len(times), n, n))
+    failed = np.zeros(len(times), dtype=bool)
+    identity = np.eye(n)
 
-    for time, item in cov.items():
-        mat = item.values
-        chol = np.linalg.inv(mat)
-        try:
-            result[time] = np.linalg.cholesky(chol)
+    for start in range(0, len(times), chunk_size):
+        chunk = slice(start, start + chunk_size)
 
+        if isinstance(cov, CovarianceTensor):
+            # float32 covariances are factorized in float64
+            flipped = cov.take(chunk).dense(dtype=np.float64)[:, ::-1, ::-1]
+        else:
+            flipped = np.stack(
+                [np.asarray(cov[time], dtype=float) for time in times[chunk]]
+            )[:, ::-1, ::-1]
+
+        try:
+            chols = np.linalg.cholesky(flipped)
         except np.linalg.LinAlgError:
-            print(time, mat)
+            # factorize one by one to find the time steps that fail
+            chols = np.zeros_like(flipped)
+            for t, mat in enumerate(flipped):
+                try:
+                    chols[t] = np.linalg.cholesky(mat)
+                except np.linalg.LinAlgError:
+                    failed[start + t] = True
+
+        failed[chunk] |= ~np.isfinite(chols).all(axis=(1, 2))
+        # the failed time steps are not returned, any factor will do
+        chols[failed[chunk]] = identity
+
+        chol_inv = sc.linalg.solve_triangular(
+            chols, np.broadcast_to(identity, chols.shape), lower=True, check_finite=False
+        )
+        Ls[chunk] = np.swapaxes(chol_inv, 1, 2)[:, ::-1, ::-1]
 
-    return result
+    result = {time: Ls[t] for t, time in enumerate(times) if not failed[t]}
 
-def _B_t_col(Ls, nus, returns):
+    return result, pd.Series(failed, index=times)
+
+
+def _nu(Ls, means):
     """
-    Computes L.T @ return for each L factor in Ls and corresponding
-    return in returns
+    Computes L.T @ mu for each L factor in Ls and corresponding
+    mu in means
     """
-    return {time: L.T @ returns.loc[time].values - nus[time] for time, L in Ls.items()}
+    return {time: L.T @ means[time] for time, L in Ls.items()}
 
 
-def _diag_part(cholesky):
-    return {key: np.diag(L) for key, L in cholesky.items()}
+class Result:
+    def __init__(self, time, L, nu, weights, assets, status=None, iterations=None):
+        """
+        Combined prediction at a time step in factor form: the precision matrix
+        is L @ L.T with L lower triangular and the mean is L^-T @ nu
+
+        The dense mean and covariance matrix are only computed when accessed;
+        solve, logdet and quad_form work with the factor directly
+
+        param time: time step of the prediction
+        param L: nxn lower triangular Cholesky factor of the precision matrix
+        param nu: vector of length n
+        param weights: weights of the experts
+        param assets: index of the assets
+        param status: status of the solver
+        param iterations: number of iterations of the solver
+        """
+        self.__time = time
+        self.__L = L
+        self.__nu = nu
+        self.__weights = weights
+        self.__assets = assets
+        self.__status = status
+        self.__iterations = iterations
 
+        self.__mean = None
+        self.__covariance = None
 
-def _A(diags_interval, K):
-    """
-    param diags_interval: NxK pandas DataFrame where each entry is diagonal
-    of an expert Cholesky factor matrix
-    param K: number of expert predictors
+    @property
+    def time(self):
+        return self.__time
 
-    returns: nNxK matrix where each column is a vector of stacked diagonals
-    """
-    return np.column_stack(
-        [np.vstack(diags_interval.iloc[:, i]).flatten() for i in range(K)]
-    )
+    @property
+    def L(self):
+        return self.__L
 
+    @property
+    def nu(self):
+        return self.__nu
 
-def _nu(Ls, means):
-    """
-    Computes L.T @ mu for each L factor in Ls and corresponding
-    mu in means
-    """
-    return {time: L.T @ means[time] for time, L in Ls.items()}
+    @property
+    def weights(self):
+        return self.__weights
 
+    @property
+    def assets(self):
+        return self.__assets
 
-# Declaring namedtuple()
-Result = namedtuple("Result", ["time", "mean", "covariance", "weights"])
+    @property
+    def status(self):
+        return self.__status
+
+    @property
+    def iterations(self):
+        return self.__iterations
+
+    @property
+    def mean(self):
+        if self.__mean is None:
+            self.__mean = pd.Series(
+                index=self.assets,
+                data=sc.linalg.solve_triangular(self.L, self.nu, lower=True, trans="T"),
+            )
+        return self.__mean
+
+    @property
+    def covariance(self):
+        """
+        Dense covariance matrix L^-T L^-1, computed on first access
+        """
+        if self.__covariance is None:
+            L_inv = sc.linalg.solve_triangular(
+                self.L, np.eye(len(self.assets)), lower=True
+            )
+            self.__covariance = pd.DataFrame(
+                index=self.assets, columns=self.assets, data=L_inv.T @ L_inv
+            )
+        return self.__covariance
+
+    @property
+    def precision(self):
+        return pd.DataFrame(
+            index=self.assets, columns=self.assets, data=self.L @ self.L.T
+        )
+
+    def solve(self, b):
+        """
+        Returns x with Sigma x = b, i.e., L @ L.T @ b
+
+        param b: vector of length n or nxm array
+        """
+        return self.L @ (self.L.T @ np.asarray(b))
+
+    def logdet(self):
+        """
+        Returns the log determinant of the covariance matrix
+        """
+        return -2 * np.sum(np.log(np.diag(self.L)))
+
+    def quad_form(self, x):
+        """
+        Returns x^T Sigma^-1 x; for an nxm array x, one value per column
+
+        param x: vector of length n or nxm array
+        """
+        return np.sum((self.L.T @ np.asarray(x)) ** 2, axis=0)
+
+    def __repr__(self):
+        return f"Result(time={self.time}, n={len(self.assets)}, status={self.status})"
 
 
 class _CombinationProblem:
@@ -100,6 +220,10 @@ class _CombinationProblem:
     def _construct_problem(self):
         self.prob = cvx.Problem(cvx.Maximize(self._objective), self._constraints)
 
+    def update(self, A, P_chol):
+        self.A_param.value = A
+        self.P_chol_param.value = P_chol
+
     def solve(self, **kwargs):
         return self.prob.solve(**kwargs)
 
@@ -111,9 +235,134 @@ class _CombinationProblem:
     def status(self):
         return self.prob.status
 
+    @property
+    def iterations(self):
+        return self.prob.solver_stats.num_iters
+
+
+class _NewtonCombinationProblem:
+    def __init__(self, keys, n, window):
+        """
+        Specialized solver for the combination problem
+
+            maximize sum(log(A @ w)) - 0.5 * ||P_chol.T @ w||^2
+            subject to sum(w) = 1, w >= 0
+
+        with a barrier method: w >= 0 is replaced by the term mu * sum(log(w))
+        and the equality constrained problem is solved by damped Newton steps,
+        for a decreasing sequence of mu. Each solve warm starts from the
+        weights of the previous one.
+        """
+        self.keys = keys
+        self.K = len(keys)
+        self._weight = None
+        self._status = None
+        self._iterations = None
+
+    def _construct_problem(self):
+        self._weight = None
+
+    def update(self, A, P_chol):
+        self.A = A
+        self.P = P_chol @ P_chol.T
+
+    def _objective(self, w, mu):
+        s = self.A @ w
+        if (s <= 0).any() or (w <= 0).any():
+            return -np.inf
+        return np.sum(np.log(s)) - 0.5 * w @ self.P @ w + mu * np.sum(np.log(w))
+
+    def solve(self, tol=1e-8, max_iter=100, mu_factor=0.01):
+        """
+        param tol: the barrier parameter is decreased until K * mu < tol, which
+        bounds the suboptimality of the objective
+        param max_iter: maximum number of Newton steps
+        param mu_factor: factor to decrease mu by after each centering step
+
+        returns: the objective value
+        """
+        K = self.K
+
+        if self._weight is None:
+            w, mu = np.ones(K) / K, 1.0
+        else:
+            # pull the previous solution into the interior of the simplex
+            w, mu = 0.99 * self._weight + 0.01 / K, 1e-4
+
+        # KKT system of the equality constrained Newton step
+        KKT = np.zeros((K + 1, K + 1))
+        KKT[:K, K] = KKT[K, :K] = 1.0
+        rhs = np.zeros(K + 1)
+
+        iterations = 0
+        converged = False
+
+        while iterations < max_iter:
+            # centering step: Newton on the barrier problem for fixed mu
+            while iterations < max_iter:
+                s = self.A @ w
+                As = self.A / s.reshape(-1, 1)
+
+                g = As.sum(axis=0) - self.P @ w + mu / w
+                KKT[:K, :K] = -As.T @ As - self.P - np.diag(mu / w**2)
+                rhs[:K] = -g
+                dw = np.linalg.solve(KKT, rhs)[:K]
+
+                iterations += 1
+                decrement = g @ dw
+                if decrement / 2 <= tol:
+                    break
+
+                # backtracking line search, starting from a step that stays in
+                # the interior of the domain
+                ds = self.A @ dw
+                step = min(
+                    1.0,
+                    0.99 * np.min(-w[dw < 0] / dw[dw < 0], initial=np.inf),
+                    0.99 * np.min(-s[ds < 0] / ds[ds < 0], initial=np.inf),
+                )
+                f = self._objective(w, mu)
+                while self._objective(w + step * dw, mu) < f + 0.25 * step * decrement:
+                    step *= 0.5
+                    if step < 1e-12:
+                        break
+                w = w + step * dw
+
+            if K * mu < tol:
+                converged = True
+                break
+            mu *= mu_factor
+
+        self._weight = w
+        self._iterations = iterations
+        self._status = "optimal" if converged else "optimal_inaccurate"
+
+        return self._objective(w, 0.0)
+
+    @property
+    def weights(self):
+        return pd.Series(index=self.keys, data=self._weight)
+
+    @property
+    def status(self):
+        return self._status
+
+    @property
+    def iterations(self):
+        return self._iterations
+
+
+_BACKENDS = {"cvxpy": _CombinationProblem, "newton": _NewtonCombinationProblem}
+
 
 def from_ewmas(
-    returns, pairs, min_periods_vola=20, min_periods_cov=20, clip_at=None, mean=False
+    returns,
+    pairs,
+    min_periods_vola=20,
+    min_periods_cov=20,
+    clip_at=None,
+    mean=False,
+    dtype=np.float64,
 ):
     """
     Estimate a series of covariance matrices using the iterated EWMA method
@@ -126,29 +375,33 @@ def from_ewmas(
     param min_periods_cov: minimum number of observations to start EWMA for covariance estimation (optional)
     param clip_at: clip volatility adjusted returns at +- clip_at (optional)
     param mean: subtract EWMA mean from returns and volatility adjusted returns (optional)
+    param dtype: floating point type of the expert covariances, np.float32
+    halves their memory; the combination itself runs in float64
 
     return: Yields tuples with time, mean, covariance matrix, weights
     """
-    # compute the covariance matrices, one time series for each pair
-    results = {
-        f"{pair[0]}-{pair[1]}": {
-            result.time: result
-            for result in iterated_ewma(
-                returns=returns,
-                vola_halflife=pair[0],
-                cov_halflife=pair[1],
-                min_periods_vola=min_periods_vola,
-                min_periods_cov=min_periods_cov,
-                clip_at=clip_at,
-                mean=mean,
-            )
+    # compute the covariance matrices, one time series for each pair, in a
+    # single pass over the returns
+    tensors = iterated_ewma_tensors(
+        returns=returns,
+        pairs=pairs,
+        min_periods_vola=min_periods_vola,
+        min_periods_cov=min_periods_cov,
+        clip_at=clip_at,
+        mean=mean,
+        packed=True,
+        dtype=dtype,
+    )
+
+    sigmas = {key: tensor.covariance for key, tensor in tensors.items()}
+    means = {
+        key: {
+            time: pd.Series(tensor.mean[k], index=tensor.assets)
+            for k, time in enumerate(tensor.time)
         }
-        for pair in pairs
+        for key, tensor in tensors.items()
     }
 
-    sigmas = _map_nested_dicts(results, lambda result: result.covariance)
-    means = _map_nested_dicts(results, lambda result: result.mean)
-
     # combination of covariance matrix valued time series
     return _CovarianceCombination(sigmas=sigmas, returns=returns, means=means)
 
@@ -162,7 +415,8 @@ class _CovarianceCombination:
         """
         Computes the covariance combination of a set of covariance matrices
 
-        param sigmas: dictionary of covariance matrices {key: {time: sigma}}
+        param sigmas: dictionary of covariance matrices {key: {time: sigma}},
+        the inner dictionaries may be CovarianceTensor
         param returns: pandas DataFrame of returns
         param means: dictionary of means {key: {time: mu}}, optional
 
@@ -188,12 +442,31 @@ class _CovarianceCombination:
         self.__returns = returns
 
         # all those quantities don't depend on the window size
-        self.__Ls = pd.DataFrame(
-            {k: _cholesky_precision(sigma) for k, sigma in self.sigmas.items()}
-        )
+        with instrumentation.stage("combination.cholesky"):
+            factors = {
+                k: _cholesky_precision(sigma) for k, sigma in self.sigmas.items()
+            }
+        self.__Ls = pd.DataFrame({k: Ls for k, (Ls, _) in factors.items()})
+        self.__failures = pd.DataFrame(
+            {k: failed for k, (_, failed) in factors.items()}
+        ).fillna(False).astype(bool)
+
+        recorder = instrumentation.active()
+        if recorder is not None:
+            for key, failed in self.__failures.items():
+                for time in failed.index[failed.values]:
+                    recorder.event("factorization_failure", key=key, time=time)
+
+        if self.__failures.values.any():
+            warnings.warn(
+                f"{int(self.__failures.values.sum())} covariance matrices are not "
+                "positive definite and are left out, see failures"
+            )
+
         self.__Ls_shifted = self.__Ls.shift(1).dropna()
         self.__nus = pd.DataFrame(
-            {key: _nu(Ls, self.means[key]) for key, Ls in self.__Ls.items()}
+            # time steps where another key failed to factorize are NaN
+            {key: _nu(Ls.dropna(), self.means[key]) for key, Ls in self.__Ls.items()}
         )
         self.__nus_shifted = self.__nus.shift(1).dropna()
 
@@ -209,6 +482,14 @@ class _CovarianceCombination:
     def returns(self):
         return self.__returns
 
+    @property
+    def failures(self):
+        """
+        Returns a boolean DataFrame (time x expert), True where the covariance
+        matrix of an expert could not be factorized
+        """
+        return self.__failures
+
     @property
     def K(self):
         """
@@ -223,7 +504,15 @@ class _CovarianceCombination:
         """
         return self.returns.columns
 
-    def solve(self, window=None, times=None, **kwargs):
+    def solve(
+        self,
+        window=None,
+        times=None,
+        backend="cvxpy",
+        processes=None,
+        chunk_size=None,
+        **kwargs,
+    ):
         """
         The size of the window is crucial to specify the size of the parameters
         for the cvxpy problem. Hence those computations are not in the __init__ method
@@ -233,24 +522,27 @@ class _CovarianceCombination:
         param window: number of previous time steps to use in the covariance
         combination problem
         param times: list of time steps to solve the problem at; if None, solve at all available time steps
+        param backend: "cvxpy" for the reference conic solve, "newton" for the
+        specialized barrier method warm started from the previous time step
+        param processes: if larger than 1, the time steps are split into chunks
+        that are solved in a pool of processes; results are still yielded in
+        time order
+        param chunk_size: number of time steps per chunk (optional)
+        param kwargs: passed to the solve of the backend, e.g. solver="ECOS"
+        for cvxpy or tol=1e-8 for newton
+
+        Note: each problem only depends on the window previous time steps, hence
+        each chunk is solved independently after window - 1 warm up time steps
         """
         # If window is None, use all available data; cap window at length of data
         window = window or len(self.__Ls_shifted)
         window = min(window, len(self.__Ls_shifted))
 
-        # Compute P matrix and its Cholesky factor
-        Lts_at_r = pd.DataFrame(
-            {
-                key: _B_t_col(Ls, self.__nus_shifted[key], self.returns)
-                for key, Ls in self.__Ls_shifted.items()
-            }
-        )
-
         # time steps to solve the problem at
-        all_available_times = Lts_at_r.index
+        all_available_times = self.__Ls_shifted.index
 
         if times is None:
-            times = Lts_at_r.index
+            times = list(all_available_times)
         else:
             times = list(times)
 
@@ -266,61 +558,180 @@ class _CovarianceCombination:
                 list(all_available_times[zero_index - window + 1 : zero_index]) + times
             )
 
-        Bs = {time: np.column_stack(Lts_at_r.loc[time]) for time in times}
-        prod_Bs = pd.Series({time: B.T @ B for time, B in Bs.items()})
-        # times = prod_Bs.index
-        P = {
-            times[i]: sum(prod_Bs.loc[times[i - window + 1] : times[i]])
-            for i in range(window - 1, len(times))
-        }
+        # stacked per time step: the K Cholesky factors and the K nus of the
+        # previous time step (shifted), of the time step itself, and the returns
+        path = dict(
+            times=times,
+            Ls_shifted=self.__Ls_shifted.loc[times].to_numpy(),
+            nus_shifted=self.__nus_shifted.loc[times].to_numpy(),
+            returns=self.returns.loc[times].values,
+            Ls=self.__Ls.loc[times].to_numpy(),
+            nus=self.__nus.loc[times].to_numpy(),
+        )
+        problem = dict(
+            keys=list(self.sigmas.keys()),
+            assets=self.assets,
+            window=window,
+            backend=backend,
+        )
+
+        if not processes or processes <= 1:
+            yield from _solve_path(**path, **problem, **kwargs)
+            return
+
+        chunk_size = chunk_size or max(
+            1, int(np.ceil((len(times) - window + 1) / (4 * processes)))
+        )
+
+        def chunk(start):
+            # the chunk starts window - 1 time steps earlier to warm up
+            first, stop = start - window + 1, start + chunk_size
+            return {
+                **{key: value[first:stop] for key, value in path.items()},
+                **problem,
+                **kwargs,
+            }
+
+        # the workers send their records back with the results of their chunk
+        recorder = instrumentation.active()
+
+        def results(future):
+            chunk_results, records = future.result()
+            for record in records:
+                recorder.record(record)
+            return chunk_results
+
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            # keep a bounded number of chunks in flight, in time order
+            futures = deque()
+            for start in range(window - 1, len(times), chunk_size):
+                futures.append(
+                    executor.submit(_solve_chunk, chunk(start), recorder is not None)
+                )
+                if len(futures) > 2 * processes:
+                    yield from results(futures.popleft())
+
+            while futures:
+                yield from results(futures.popleft())
+
+
+def _solve_path(
+    times, Ls_shifted, nus_shifted, returns, Ls, nus, keys, assets, window, backend, **kwargs
+):
+    """
+    Solves the covariance combination problem along consecutive time steps;
+    the first window - 1 time steps only fill the window
+
+    param times: list of T time steps
+    param Ls_shifted: TxK array of the Cholesky factors of the previous time step
+    param nus_shifted: TxK array of the nus of the previous time step
+    param returns: Txn array of returns
+    param Ls: TxK array of the Cholesky factors of each time step
+    param nus: TxK array of the nus of each time step
+    """
+    n = len(assets)
+    K = len(keys)
 
-        P_chol = {time: np.linalg.cholesky(matrix) for time, matrix in P.items()}
+    # ring buffers over the last window time steps of B'B and of the
+    # stacked diagonals of the Cholesky factors; P is their rolling sum and
+    # A stacks the diagonals (the objective sums over the rows of A, hence
+    # their order does not matter)
+    prod_Bs = np.zeros((window, K, K))
+    diags = np.zeros((window, n, K))
+    P = np.zeros((K, K))
 
-        # Compute A matrix
-        Ls_diag = pd.DataFrame({k: _diag_part(L) for k, L in self.__Ls_shifted.items()})
+    problem = _BACKENDS[backend](keys=keys, n=n, window=window)
 
-        A = {
-            times[i]: _A(
-                Ls_diag.truncate(before=times[i - window + 1], after=times[i]), self.K
+    problem._construct_problem()
+
+    # looked up once, nothing is recorded per time step if None
+    recorder = instrumentation.active()
+    no_stage = nullcontext()
+
+    for i, time in enumerate(times):
+        with recorder.stage("combination.assembly") if recorder else no_stage:
+            L = np.stack(Ls_shifted[i])
+            # column k of B is L_k.T @ r - nu_k
+            B = (np.swapaxes(L, 1, 2) @ returns[i] - np.stack(nus_shifted[i])).T
+            prod_B = B.T @ B
+
+            # add the newest B'B and subtract the oldest
+            slot = i % window
+            P += prod_B - prod_Bs[slot]
+            prod_Bs[slot] = prod_B
+            diags[slot] = np.diagonal(L, axis1=1, axis2=2).T
+
+        if i < window - 1:
+            continue
+
+        try:
+            with recorder.stage("combination.solve") if recorder else no_stage:
+                problem.update(
+                    A=diags.reshape(window * n, K), P_chol=np.linalg.cholesky(P)
+                )
+                result = _solve(
+                    time=time,
+                    problem=problem,
+                    Ls=Ls[i],
+                    nus=nus[i],
+                    assets=assets,
+                    **kwargs,
+                )
+        except (cvx.SolverError, np.linalg.LinAlgError) as error:
+            # the next solve starts from scratch
+            problem._construct_problem()
+            if recorder:
+                recorder.event(
+                    "solver_failure", time=time, backend=backend, error=repr(error)
+                )
+            yield None
+            continue
+
+        if recorder:
+            recorder.event(
+                "solve",
+                time=time,
+                backend=backend,
+                status=result.status,
+                iterations=result.iterations,
             )
-            for i in range(window - 1, len(times))
-        }
+        yield result
 
-        problem = _CombinationProblem(
-            keys=self.sigmas.keys(), n=len(self.assets), window=window
-        )
 
-        problem._construct_problem()
+def _solve_chunk(chunk, record=False):
+    """
+    Solves one chunk of time steps in a worker process
 
-        for time, AA in A.items():
-            problem.A_param.value = AA
-            problem.P_chol_param.value = P_chol[time]
+    returns: list of results and list of the records of the chunk, empty if
+    record is False
+    """
+    if not record:
+        return list(_solve_path(**chunk)), []
 
-            try:
-                yield self._solve(time=time, problem=problem, **kwargs)
-            except cvx.SolverError:
-                yield None
+    with instrumentation.recording() as recorder:
+        return list(_solve_path(**chunk)), recorder.records
 
-    def _solve(self, time, problem, **kwargs):
-        """
-        Solves the covariance combination problem at a given time t
-        """
-        problem.solve(**kwargs)
 
-        weights = problem.weights
+def _solve(time, problem, Ls, nus, assets, **kwargs):
+    """
+    Solves the covariance combination problem at a given time t
 
-        # Get non-shifted L
-        L = sum(self.__Ls.loc[time] * weights.values)  # prediction for time+1
-        nu = sum(self.__nus.loc[time] * weights.values)  # prediction for time+1
+    param Ls: the K Cholesky factors at time t (not shifted)
+    param nus: the K nus at time t (not shifted)
+    """
+    problem.solve(**kwargs)
 
-        mean = pd.Series(index=self.assets, data=np.linalg.inv(L.T) @ nu)
-        sigma = pd.DataFrame(
-            index=self.assets, columns=self.assets, data=np.linalg.inv(L @ L.T)
-        )
+    weights = problem.weights
 
-        mean = pd.Series(index=self.assets, data=np.linalg.inv(L.T) @ nu)
-        sigma = pd.DataFrame(
-            index=self.assets, columns=self.assets, data=np.linalg.inv(L @ L.T)
-        )
+    L = sum(Ls * weights.values)  # prediction for time+1
+    nu = sum(nus * weights.values)  # prediction for time+1
 
-        return Result(time=time, mean=mean, covariance=sigma, weights=weights)
+    return Result(
+        time=time,
+        L=L,
+        nu=nu,
+        assets=assets,
+        weights=weights,
+        status=problem.status,
+        iterations=problem.iterations,
+    )
@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+import numpy as np
+import pandas as pd
+
+from .ewma_functions import _ewma_covs, iterated_ewma_tensor
+from .regularization_functions import LowRankDiag
+
+
+def factor_covariance(
+    returns,
+    factors,
+    loading_halflife=125,
+    residual_halflife=63,
+    factor_halflife=125,
+    factor_vola_halflife=None,
+    min_periods_loading=63,
+    min_periods_residual=20,
+):
+    """
+    Factor model covariance matrices Sigma_t = B_t Sigma_f,t B_t^T + diag(d_t)
+    with time varying loadings B_t, factor covariance Sigma_f,t and
+    idiosyncratic variances d_t
+
+    param returns: pandas DataFrame of asset returns, NaN where an asset has
+    no return
+    param factors: pandas DataFrame of factor returns, e.g.
+    load("factors") or load("ff5_no_rf"), see data_functions
+    param loading_halflife: half life of the EWMA regression of each asset on
+    the factors
+    param residual_halflife: half life of the EWMA of the squared residuals
+    param factor_halflife: EWMA half life of the factor covariance
+    param factor_vola_halflife: if given, the factor covariance is the
+    iterated EWMA with this volatility half life and factor_halflife, see
+    iterated_ewma; otherwise a plain EWMA
+    param min_periods_loading: number of returns of an asset before its
+    loadings are estimated; also the min_periods of the factor covariance
+    param min_periods_residual: number of residuals of an asset before it is
+    part of the estimates
+
+    returns: a generator over (time, LowRankDiag) on the time steps of both
+    returns and factors, with F (n x k DataFrame, F F^T = B Sigma_f B^T) and
+    d (Series) of the assets alive with an estimate at that time step; F is
+    B C with C the Cholesky factor of Sigma_f, i.e., its columns 0, ..., k-1
+    are latent directions, not the exposures to the factors; as in
+    dynamic_iterated_ewma, an asset enters the universe at its first return
+    and leaves it after its last return
+
+    Note: the loadings of an asset are the EWMA least squares coefficients
+    (without intercept) of its returns on the factors, and its residuals are
+    the ones of the loadings of the previous time step, i.e., out of sample.
+    A missing return only ages the past ones, each asset has its own weights
+    as in dynamic_iterated_ewma. The state is the k x k factor Gram matrix and
+    the k cross moments of each asset, only the ones of the m assets alive
+    are updated, hence each time step costs O(m k^3), linear in the number of
+    assets, instead of the O(m^2) of the dense estimators
+    """
+    times = returns.index.intersection(factors.index)
+    assets = returns.columns
+
+    values = returns.loc[times].values.astype(float)
+    f = factors.loc[times].values.astype(float)
+    assert not np.isnan(f).any(), "factors must not have missing returns"
+
+    T, n = values.shape
+    k = f.shape[1]
+
+    factor_covs = _factor_covariances(
+        factors.loc[times],
+        halflife=factor_halflife,
+        vola_halflife=factor_vola_halflife,
+        min_periods=min_periods_loading,
+    )
+
+    loading_beta = 1 - (1 - np.exp(-np.log(2) / loading_halflife))
+    residual_beta = 1 - (1 - np.exp(-np.log(2) / residual_halflife))
+
+    # weighted sums of f f^T and r f^T of the returns of each asset
+    gram = np.zeros((n, k, k))
+    cross = np.zeros((n, k))
+    count = np.zeros(n, dtype=int)
+
+    # weighted sum and weight of the squared residuals of each asset
+    residual_sum = np.zeros(n)
+    residual_weight = np.zeros(n)
+    residual_count = np.zeros(n, dtype=int)
+
+    loadings = np.full((n, k), np.nan)
+
+    # time steps of the first and of the last return of each asset
+    listed = ~np.isnan(values)
+    first = np.where(listed.any(axis=0), listed.argmax(axis=0), T)
+    last = np.where(listed.any(axis=0), T - 1 - listed[::-1].argmax(axis=0), -1)
+
+    for t, time in enumerate(times):
+        alive = np.flatnonzero((first <= t) & (t <= last))
+        x = values[t, alive]
+        observed = ~np.isnan(x)
+
+        # out of sample residuals of the assets with loadings
+        fitted = observed & ~np.isnan(loadings[alive, 0])
+        residuals = x[fitted] - loadings[alive[fitted]] @ f[t]
+        residual_sum[alive] *= residual_beta
+        residual_weight[alive] *= residual_beta
+        residual_sum[alive[fitted]] += residuals**2
+        residual_weight[alive[fitted]] += 1.0
+        residual_count[alive[fitted]] += 1
+
+        gram[alive] *= loading_beta
+        cross[alive] *= loading_beta
+        gram[alive[observed]] += np.outer(f[t], f[t])
+        cross[alive[observed]] += np.outer(x[observed], f[t])
+        count[alive[observed]] += 1
+
+        estimated = alive[count[alive] >= min_periods_loading]
+        loadings[estimated] = _solve(gram[estimated], cross[estimated])
+
+        active = estimated[
+            ~np.isnan(loadings[estimated, 0])
+            & (residual_count[estimated] >= min_periods_residual)
+        ]
+        if len(active) == 0 or np.isnan(factor_covs[t]).any():
+            continue
+
+        L = np.linalg.cholesky(factor_covs[t])
+        yield time, LowRankDiag(
+            F=pd.DataFrame(loadings[active] @ L, index=assets[active]),
+            d=pd.Series(
+                residual_sum[active] / residual_weight[active], index=assets[active]
+            ),
+        )
+
+
+def _factor_covariances(factors, halflife, vola_halflife, min_periods):
+    """
+    returns: (T, k, k) array of the factor covariances, NaN at the time steps
+    without an estimate
+    """
+    T, k = factors.shape
+    covs = np.full((T, k, k), np.nan)
+
+    if vola_halflife is None:
+        (cov,) = _ewma_covs(
+            [factors.values], experts=[(0, halflife)], min_periods=min_periods
+        )
+        covs[T - len(cov) :] = cov
+    else:
+        tensor = iterated_ewma_tensor(
+            factors,
+            vola_halflife,
+            halflife,
+            min_periods_vola=min_periods,
+            min_periods_cov=min_periods,
+        )
+        covs[factors.index.get_indexer(tensor.time)] = tensor.covariance
+
+    return covs
+
+
+def _solve(gram, cross):
+    """
+    returns: the least squares coefficients gram^{-1} cross of each asset,
+    NaN where gram is singular
+    """
+    try:
+        return np.linalg.solve(gram, cross[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        coefficients = np.full(cross.shape, np.nan)
+        for i in range(len(gram)):
+            try:
+                coefficients[i] = np.linalg.solve(gram[i], cross[i])
+            except np.linalg.LinAlgError:
+                pass
+        return coefficients
@@ -1,77 +1,316 @@
 from __future__ import annotations
 
+import functools
 from collections import namedtuple
+from collections.abc import Mapping
 
 import numpy as np
 import pandas as pd
 from pandas._typing import TimedeltaConvertibleTypes
 
-def rolling_window(returns, memory, min_periods=20):
-    min_periods = max(min_periods, 1)
+def rolling_window(
+    returns, memory, min_periods=20, packed=False, sink=None, dtype=np.float64
+):
+    """
+    param returns: Frame of returns
+    param memory: number of observations in the window
+    param min_periods: minimum number of observations to start estimation
+    param packed: if True, returns a CovarianceTensor instead of a dictionary
+    param sink: if given, each estimate is passed to sink.append(time, Sigma)
+    as soon as it is computed instead of being kept in memory, e.g. a
+    StoreWriter with the assets as columns; Sigma is a numpy array, the packed
+    upper triangle if packed
+    param dtype: floating point type of the estimates, e.g. np.float32 to
+    halve their memory; see iter_rolling_window
+
+    returns: dictionary of covariance matrices {time: Sigma}; or the sink
+    """
+    estimates = iter_rolling_window(
+        returns, memory, min_periods, packed=packed, dtype=dtype
+    )
+
+    if sink is not None:
+        for time, Sigma in estimates:
+            sink.append(time, Sigma)
+        return sink
 
-    times = returns.index
     assets = returns.columns
 
-    returns = returns.values
+    if packed:
+        times, Sigmas = [], []
+        for time, Sigma in estimates:
+            times.append(time)
+            Sigmas.append(Sigma)
 
-    Sigmas = np.zeros((returns.shape[0], returns.shape[1], returns.shape[1]))
-    Sigmas[0] = np.outer(returns[0], returns[0])
+        n = len(assets)
+        Sigmas = np.array(Sigmas, dtype=dtype).reshape(len(times), n * (n + 1) // 2)
+        return CovarianceTensor(Sigmas, time=pd.Index(times), assets=assets)
 
-    for t in range(1, returns.shape[0]):
-        alpha_old = 1 / min(t + 1, memory)
-        alpha_new = 1 / min(t + 2, memory)
+    return {
+        time: pd.DataFrame(Sigma, index=assets, columns=assets)
+        for time, Sigma in estimates
+    }
 
-        if t >= memory:
-            Sigmas[t] = alpha_new / alpha_old * Sigmas[t - 1] + alpha_new * (
-                np.outer(returns[t], returns[t])
-                - np.outer(returns[t - memory], returns[t - memory])
-            )
+
+def iter_rolling_window(returns, memory, min_periods=20, packed=False, dtype=np.float64):
+    """
+    Streaming version of rolling_window, yields (time, Sigma) one time step
+    at a time; only the last estimate and the last memory returns are kept,
+    i.e., O(n^2 + memory n) memory, independent of the number of time steps
+
+    param returns: Frame of returns
+    param memory: number of observations in the window
+    param min_periods: minimum number of observations to start estimation
+    param packed: if True, Sigma is the packed upper triangle
+    param dtype: floating point type of Sigma
+
+    Note: Sigma is a numpy array and is not modified after it is yielded;
+    the recursion always runs in float64, as it subtracts the outer products
+    leaving the window, hence its rounding errors would add up over time in
+    float32; with np.float32 Sigma is only rounded, i.e., its entries differ
+    from float64 by less than 1e-7 of the largest entry of the same matrix
+    """
+    min_periods = max(min_periods, 1)
+    n = returns.shape[1]
+
+    if packed:
+        # the recursion is linear, hence it can run on the upper triangles
+        upper = np.triu_indices(n)
+
+        def outer(x):
+            return x[upper[0]] * x[upper[1]]
+
+    else:
+
+        def outer(x):
+            return np.outer(x, x)
+
+    # ring buffer of the last memory returns
+    history = np.zeros((memory, n))
+
+    for t, (time, row) in enumerate(zip(returns.index, returns.values)):
+        if t == 0:
+            Sigma = outer(row)
         else:
-            Sigmas[t] = alpha_new / alpha_old * Sigmas[t - 1] + alpha_new * (
-                np.outer(returns[t], returns[t])
-            )
+            alpha_old = 1 / min(t + 1, memory)
+            alpha_new = 1 / min(t + 2, memory)
 
-    Sigmas = Sigmas[min_periods - 1 :]
-    times = times[min_periods - 1 :]
+            if t >= memory:
+                # history[t % memory] holds the returns at time t - memory
+                Sigma = alpha_new / alpha_old * Sigma + alpha_new * (
+                    outer(row) - outer(history[t % memory])
+                )
+            else:
+                Sigma = alpha_new / alpha_old * Sigma + alpha_new * (outer(row))
 
-    return {
-        times[t]: pd.DataFrame(Sigmas[t], index=assets, columns=assets)
-        for t in range(len(times))
-    }
+        history[t % memory] = row
+
+        if t >= min_periods - 1:
+            yield time, Sigma if dtype == np.float64 else Sigma.astype(dtype)
 
 def add_to_diagonal(Sigmas, lamda):
     """
     Adds lamda*diag(Sigma) to each covariance (Sigma) matrix in Sigmas
 
-    param Sigmas: dictionary of covariance matrices
+    param Sigmas: dictionary of covariance matrices or CovarianceTensor
     param lamda: scalar
+
+    returns: new dictionary or CovarianceTensor, Sigmas is left unchanged,
+    e.g. a tensor backed by a read-only memmap or shared with other experts
     """
-    for key in Sigmas.keys():
-        Sigmas[key] = Sigmas[key] + lamda * np.diag(np.diag(Sigmas[key]))
+    if isinstance(Sigmas, CovarianceTensor):
+        packed = np.array(Sigmas.packed)
+        packed[:, diagonal_positions(Sigmas.n)] *= 1 + lamda
+        return CovarianceTensor(packed, time=Sigmas.time, assets=Sigmas.assets)
 
-    return Sigmas
+    return {
+        key: Sigma + lamda * np.diag(np.diag(Sigma)) for key, Sigma in Sigmas.items()
+    }
 
 def from_row_to_covariance(row, n):
     """
     Convert upper diagonal part of covariance matrix to a covariance matrix
     """
-    Sigma = np.zeros((n, n))
-
-    # set upper triangular part
-    upper_mask = np.triu(np.ones((n, n)), k=0).astype(bool)
-    Sigma[upper_mask] = row
+    return unpack_covariances(np.asarray(row), n)
 
-    # set lower triangular part
-    lower_mask = np.tril(np.ones((n, n)), k=0).astype(bool)
-    Sigma[lower_mask] = Sigma.T[lower_mask]
-    return Sigma
 
 def from_row_matrix_to_covariance(M, n):
     """
     Convert Tx(n(n+1)/2) matrix of upper diagonal parts of covariance matrices to a Txnxn matrix of covariance matrices
     """
-    Sigmas = []
-    T = M.shape[0]
-    for t in range(T):
-        Sigmas.append(from_row_to_covariance(M[t], n))
-    return np.array(Sigmas)
\ No newline at end of file
+    return unpack_covariances(np.asarray(M), n)
+
+
+def pack_covariances(Sigmas):
+    """
+    Convert (...)xnxn array of symmetric matrices to a (...)x(n(n+1)/2) array of
+    their upper diagonal parts (row major, as in from_row_to_covariance)
+    """
+    Sigmas = np.asarray(Sigmas)
+    upper = _triu_indices(Sigmas.shape[-1])
+    return Sigmas[..., upper[0], upper[1]]
+
+
+def unpack_covariances(M, n, dtype=None):
+    """
+    Convert (...)x(n(n+1)/2) array of upper diagonal parts to a (...)xnxn array of
+    symmetric matrices; vectorized over all leading dimensions
+    """
+    Sigmas = np.take(M, _packed_positions(n), axis=-1)
+    return Sigmas if dtype is None else Sigmas.astype(dtype, copy=False)
+
+
+@functools.lru_cache(maxsize=16)
+def _triu_indices(n):
+    """
+    np.triu_indices(n), computed once per n
+    """
+    return np.triu_indices(n)
+
+
+@functools.lru_cache(maxsize=16)
+def _packed_positions(n):
+    """
+    nxn array of the position of each entry in a packed row; unpacking is a
+    single gather
+    """
+    upper = _triu_indices(n)
+    positions = np.empty((n, n), dtype=np.intp)
+    positions[upper] = np.arange(len(upper[0]))
+    positions[upper[::-1]] = np.arange(len(upper[0]))
+    return positions
+
+
+def diagonal_positions(n):
+    """
+    Positions of the diagonal entries in a packed row of length n(n+1)/2
+    """
+    i = np.arange(n)
+    return i * n - i * (i - 1) // 2
+
+
+class CovarianceTensor(Mapping):
+    def __init__(self, packed, time, assets):
+        """
+        Time series of symmetric matrices, stored as packed upper triangles
+
+        param packed: Tx(n(n+1)/2) array, row t is the upper diagonal part of the
+        matrix at time[t], see pack_covariances
+        param time: index of length T
+        param assets: index of length n
+
+        Note: the tensor behaves like the dictionary {time: covariance matrix}
+        used throughout covariance_functions; the DataFrame of a single time
+        step is only unpacked when it is accessed
+        """
+        self.__time = pd.Index(time)
+        self.__assets = pd.Index(assets)
+
+        n = len(self.__assets)
+        assert packed.shape == (
+            len(self.__time),
+            n * (n + 1) // 2,
+        ), "packed must be of shape (T, n(n+1)/2)"
+
+        self.__packed = packed
+
+    @classmethod
+    def from_dense(cls, Sigmas, time, assets):
+        """
+        param Sigmas: Txnxn array of symmetric matrices
+        """
+        return cls(pack_covariances(Sigmas), time=time, assets=assets)
+
+    @classmethod
+    def from_dict(cls, sigmas):
+        """
+        param sigmas: dictionary of covariance matrices {time: Sigma}
+        """
+        times = list(sigmas.keys())
+        assets = sigmas[times[0]].columns if times else pd.Index([])
+
+        n = len(assets)
+        packed = np.empty((len(times), n * (n + 1) // 2))
+        for k, sigma in enumerate(sigmas.values()):
+            packed[k] = pack_covariances(np.asarray(sigma))
+
+        return cls(packed, time=times, assets=assets)
+
+    @classmethod
+    def from_results(cls, results):
+        """
+        param results: iterable of results with fields time and covariance,
+        e.g. the output of iterated_ewma or _CovarianceCombination.solve
+        """
+        return cls.from_dict(
+            {result.time: result.covariance for result in results if result is not None}
+        )
+
+    @property
+    def packed(self):
+        return self.__packed
+
+    @property
+    def time(self):
+        return self.__time
+
+    @property
+    def assets(self):
+        return self.__assets
+
+    @property
+    def n(self):
+        return len(self.__assets)
+
+    @property
+    def nbytes(self):
+        return self.__packed.nbytes
+
+    def __len__(self):
+        return len(self.__time)
+
+    def __iter__(self):
+        return iter(self.__time)
+
+    def __getitem__(self, key):
+        """
+        param key: a time step, returns the covariance DataFrame at that time;
+        or a slice of time steps (label based, as in .loc), returns a tensor
+        viewing the same packed rows
+        """
+        if isinstance(key, slice):
+            indexer = self.__time.slice_indexer(key.start, key.stop, key.step)
+            return CovarianceTensor(
+                self.__packed[indexer], time=self.__time[indexer], assets=self.assets
+            )
+
+        k = self.__time.get_loc(key)
+        return pd.DataFrame(
+            unpack_covariances(self.__packed[k], self.n),
+            index=self.assets,
+            columns=self.assets,
+            copy=False,
+        )
+
+    def take(self, positions):
+        """
+        Tensor with the time steps at the given integer positions
+        """
+        return CovarianceTensor(
+            self.__packed[positions], time=self.__time[positions], assets=self.assets
+        )
+
+    def dense(self, dtype=None):
+        """
+        Returns the Txnxn array of all matrices
+        """
+        return unpack_covariances(self.__packed, self.n, dtype=dtype)
+
+    def diagonal(self):
+        """
+        Returns the Txn array of all diagonals
+        """
+        return self.__packed[:, diagonal_positions(self.n)]
+
+    def __repr__(self):
+        return f"CovarianceTensor(T={len(self)}, n={self.n})"
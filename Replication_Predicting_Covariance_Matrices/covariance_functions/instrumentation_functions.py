@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+import pandas as pd
+
+# the recorder of the innermost active recording, None if nothing is recorded
+_active = None
+
+# returned by stage when nothing is recorded
+_NO_STAGE = nullcontext()
+
+
+class Recorder:
+    def __init__(self, callbacks=None):
+        """
+        Records the wall time of the stages of a run and events such as the
+        status of each solve or failed factorizations
+
+        param callbacks: list of functions, each is called with every record
+        (a dictionary) as soon as it is recorded, e.g. to log or to plot
+        progress
+
+        Records are dictionaries with the fields "type" ("stage" or "event"),
+        "name" and further fields, e.g. "seconds" for stages; use recording()
+        to activate a recorder
+        """
+        self.callbacks = list(callbacks or [])
+        self.records = []
+
+    def record(self, record):
+        self.records.append(record)
+        for callback in self.callbacks:
+            callback(record)
+
+    def stage(self, name, **fields):
+        """
+        Context manager recording the wall time of the enclosed block
+        """
+        return _Stage(self, name, fields)
+
+    def event(self, name, **fields):
+        self.record({"type": "event", "name": name, **fields})
+
+    def stages(self):
+        """
+        returns: DataFrame with the number of calls and the total, mean and
+        maximum wall time in seconds of each stage
+        """
+        seconds = pd.DataFrame(
+            [record for record in self.records if record["type"] == "stage"],
+            columns=["name", "seconds"],
+        )
+        return seconds.groupby("name", sort=False)["seconds"].agg(
+            calls="count", total="sum", mean="mean", max="max"
+        )
+
+    def events(self, name=None):
+        """
+        returns: DataFrame of the events, only those called name if given
+        """
+        return pd.DataFrame(
+            [
+                {key: value for key, value in record.items() if key != "type"}
+                for record in self.records
+                if record["type"] == "event" and name in (None, record["name"])
+            ]
+        )
+
+    def to_jsonl(self, path):
+        """
+        Writes all records to path, one json object per line
+        """
+        with open(path, "w") as file:
+            for record in self.records:
+                file.write(json.dumps(record, default=str) + "\n")
+
+
+class _Stage:
+    def __init__(self, recorder, name, fields):
+        self.recorder = recorder
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.recorder.record(
+            {
+                "type": "stage",
+                "name": self.name,
+                "seconds": time.perf_counter() - self.start,
+                **self.fields,
+            }
+        )
+
+
+@contextmanager
+def recording(callbacks=None, recorder=None):
+    """
+    Activates a recorder for the enclosed block, e.g.
+
+        with recording() as recorder:
+            results = list(from_sigmas(Sigmas, returns).solve(window=10))
+        recorder.stages()
+
+    param callbacks: see Recorder
+    param recorder: an existing recorder to add the records to (optional)
+
+    Note: the workers of _CovarianceCombination.solve with processes > 1
+    record their chunk and send the records back with its results; they are
+    added when the results of the chunk are yielded
+    """
+    global _active
+
+    recorder = recorder or Recorder(callbacks)
+    previous, _active = _active, recorder
+    try:
+        yield recorder
+    finally:
+        _active = previous
+
+
+def active():
+    """
+    returns: the active recorder, None if nothing is recorded
+
+    Hot loops call this once and skip all recording if it is None, e.g.
+    _solve_path, instead of building the fields of every event
+    """
+    return _active
+
+
+def stage(name, **fields):
+    """
+    Context manager recording the wall time of the enclosed block with the
+    active recorder; does nothing if nothing is recorded
+    """
+    if _active is None:
+        return _NO_STAGE
+    return _active.stage(name, **fields)
+
+
+def event(name, **fields):
+    """
+    Records an event with the active recorder, if any
+    """
+    if _active is not None:
+        _active.event(name, **fields)
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import warnings
 from collections import namedtuple
 
 import numpy as np
@@ -12,27 +13,67 @@ LowRank = namedtuple("LowRank", ["Loading", "Lambda", "D", "Approximation"])
 LowRankDiag = namedtuple("LowRankCovariance", ["F", "d"])
 
 
-def _regularize_correlation(R, r):
+def _top_eigenpairs(R, r, initial=None, tol=1e-6, max_iter=20):
     """
-    param Rs: nxn numpy array of correlation matrices
-    param r: float, rank of low rank component
-
-    returns: low rank + diag approximation of R\
-        R_hat = sum_i^r lambda_i q_i q_i' + E, where E is diagonal,
-        defined so that R_hat has unit diagonal; lamda_i, q_i are eigenvalues
-        and eigenvectors of R (the r first, in descending order)
+    param R: nxn symmetric numpy array
+    param r: int, number of eigenpairs
+    param initial: nxr numpy array spanning a guess of the eigenspace, e.g.
+    the eigenvectors of a nearby matrix (optional)
+    param tol: tolerance on the residual norm of each eigenpair
+    param max_iter: maximum number of iterations
+
+    returns: the r largest eigenvalues of R in descending order and the
+    corresponding eigenvectors
+
+    Note: with an initial guess, the eigenspace is tracked with LOBPCG at a
+    cost of O(n^2 r) per iteration; when it does not converge, the eigenpairs
+    are computed from scratch with eigh
     """
+    R = np.asarray(R)
+
+    if initial is not None:
+        with warnings.catch_warnings():
+            # convergence is checked below
+            warnings.simplefilter("ignore")
+            try:
+                lamda, Q = sc.sparse.linalg.lobpcg(
+                    R, np.asarray(initial), largest=True, tol=tol, maxiter=max_iter
+                )
+            except (np.linalg.LinAlgError, ValueError):
+                lamda = None
+
+        if lamda is not None:
+            order = np.argsort(lamda)[::-1]
+            lamda, Q = lamda[order], Q[:, order]
+
+            residual = np.linalg.norm(R @ Q - Q * lamda, axis=0)
+            if np.all(residual <= tol * lamda[0]):
+                return lamda, Q
+
     # number of rows and columns in R
     n = R.shape[0]
 
     # ascending order of the largest r eigenvalues
     lamda, Q = sc.linalg.eigh(a=R, subset_by_index=[n - r, n - 1])
 
-    # Sort eigenvalues in descending order
-    lamda = lamda[::-1]
+    # Sort eigenvalues in descending order and reshuffle the eigenvectors
+    # accordingly
+    return lamda[::-1], Q[:, ::-1]
+
 
-    # reshuffle the eigenvectors accordingly
-    Q = Q[:, ::-1]
+def _regularize_correlation(R, r, initial=None, tol=1e-6, max_iter=20):
+    """
+    param Rs: nxn numpy array of correlation matrices
+    param r: float, rank of low rank component
+    param initial: nxr Loading to warm start the eigensolver (optional), see
+    _top_eigenpairs
+
+    returns: low rank + diag approximation of R\
+        R_hat = sum_i^r lambda_i q_i q_i' + E, where E is diagonal,
+        defined so that R_hat has unit diagonal; lamda_i, q_i are eigenvalues
+        and eigenvectors of R (the r first, in descending order)
+    """
+    lamda, Q = _top_eigenpairs(R, r, initial=initial, tol=tol, max_iter=max_iter)
 
     # Get low rank component
     R_lo = Q @ np.diag(lamda) @ Q.T
@@ -45,19 +86,33 @@ def _regularize_correlation(R, r):
     # return R_lo + D
 
 
-def regularize_covariance(sigmas, r, low_rank_format=False):
+def regularize_covariance(
+    sigmas, r, low_rank_format=False, warm_start=False, tol=1e-6, max_iter=20
+):
     """
     param Sigmas: dictionary of covariance matrices
     param r: float, rank of low rank component
+    param warm_start: if True, the top r eigenspace of each correlation matrix
+    is tracked from the Loading of the previous time step instead of being
+    computed from scratch; this only pays off for large universes, e.g. from
+    n = 1000 on, for smaller n the dense eigendecomposition is faster, see
+    the regularize_covariance stage of benchmarks/benchmark_pipeline.py
+    param tol: tolerance of the tracked eigenpairs (warm_start only)
+    param max_iter: maximum number of tracking iterations per time step
+    (warm_start only); then the eigenpairs are computed from scratch
 
     returns: regularized covariance matrices according to "Factor form
     regularization." of Section 7.2 in the paper "A Simple Method for Predicting Covariance Matrices of Financial Returns"
     """
+    loading = None
+
     for time, sigma in sigmas.items():
         vola = np.sqrt(np.diag(sigma)).reshape(-1, 1)
         # R = sigma / np.outer(vola, vola)
         R = (1 / vola) * sigma * (1 / vola).T
-        R = _regularize_correlation(R, r)
+        R = _regularize_correlation(R, r, initial=loading, tol=tol, max_iter=max_iter)
+        if warm_start:
+            loading = R.Loading
         # todo: requires some further work
         if not low_rank_format:
             cov = vola.reshape(-1, 1) * R.Approximation * vola.reshape(1, -1)
@@ -74,50 +129,176 @@ def regularize_covariance(sigmas, r, low_rank_format=False):
 ##### Expectation-Maximization algorithm proposed by Emmanuel Candes #####
 
 
+def _T(X):
+    """
+    Transposes the last two axes of a (stack of) matrices
+    """
+    return np.swapaxes(X, -1, -2)
+
+
 def _e_step(Sigma, F, d):
-    G = np.linalg.inv((F.T * (1 / d.values.reshape(1, -1))) @ F + np.eye(F.shape[1]))
-    L = G @ F.T * (1 / d.values.reshape(1, -1))
+    """
+    param Sigma: nxn covariance matrix, or stack of them
+    param F: nxk factor loadings, or stack of them
+    param d: vector of length n, or stack of them
+
+    Note: (F F^T + diag(d))^-1 only enters through the Woodbury identity,
+    hence only kxk matrices are inverted
+    """
+    Ft_Dinv = _T(F) / d[..., None, :]
+    G = np.linalg.inv(Ft_Dinv @ F + np.eye(F.shape[-1]))
+    L = G @ Ft_Dinv
     Cxx = Sigma
-    Cxs = Sigma @ L.T
-    Css = L @ (Sigma @ L.T) + G
+    Cxs = Sigma @ _T(L)
+    Css = L @ Cxs + G
 
     return Cxx, Cxs, Css
 
 
 def _m_step(Cxx, Cxs, Css):
-    F = Cxs @ np.linalg.inv(Css)
+    # F = Cxs @ Css^-1, Css is symmetric
+    F = _T(np.linalg.solve(Css, _T(Cxs)))
     # d = np.diag(Cxx - 2 * Cxs @ F.T + F @ Css @ F.T)
-    d = np.diag(Cxx) - 2 * np.sum(Cxs * F, axis=1) + np.sum(F * (F @ Css), axis=1)
-    return LowRankDiag(F=F, d=pd.Series(d, index=F.index))
+    d = (
+        np.diagonal(Cxx, axis1=-2, axis2=-1)
+        - 2 * np.sum(Cxs * F, axis=-1)
+        + np.sum(F * (F @ Css), axis=-1)
+    )
+    return LowRankDiag(F=F, d=d)
 
 
-def _em_low_rank_approximation(sigma, initial_sigma):
+def _relative_change(old, new):
     """
-    param sigma: one covariance matrices
-    param rank: float, rank of low rank component
+    Relative change from old to new of the low rank + diagonal approximations
+    (F, d), measured on F F^T and d; hence it does not depend on the rotation
+    of the factors
 
-    returns: regularized covariance matrices
+    Note: ||F F^T - G G^T||^2 = ||F^T F||^2 + ||G^T G||^2 - 2 ||F^T G||^2 in
+    the Frobenius norm, hence no nxn matrix is formed
+    """
+
+    def squared_norm(X):
+        return np.sum(X**2, axis=(-2, -1))
+
+    FtF = squared_norm(_T(old.F) @ old.F)
+    change = FtF + squared_norm(_T(new.F) @ new.F) - 2 * squared_norm(_T(old.F) @ new.F)
+    change = np.maximum(change, 0) + np.sum((new.d - old.d) ** 2, axis=-1)
+
+    return np.sqrt(change / (FtF + np.sum(old.d**2, axis=-1)))
+
+
+def _initial_low_rank(sigma, rank):
+    """
+    Factor form regularization of sigma as starting point of the EM algorithm
+
+    returns: LowRankDiag with numpy arrays F (nxrank) and d
+    """
+    sigma = np.asarray(sigma)
+    vola = np.sqrt(np.diag(sigma))
+    R = _regularize_correlation(sigma / np.outer(vola, vola), rank)
+
+    F = vola.reshape(-1, 1) * R.Loading * np.sqrt(R.Lambda)
+    # keep the diagonal positive for the E-step
+    d = np.maximum(np.diag(R.D), 1e-8) * vola**2
+
+    return LowRankDiag(F=F, d=d)
+
+
+def _em_low_rank_approximation(sigma, initial_sigma, tol=None, max_iter=5):
     """
-    assets = sigma.columns
-    F = initial_sigma.F
-    d = initial_sigma.d
+    param sigma: one covariance matrices, or stack of them
+    param initial_sigma: LowRankDiag with F and d, or stacks of them, to start
+    from
+    param tol: stops once the relative change of the approximation is below
+    tol, see _relative_change; if None, runs max_iter iterations
+    param max_iter: maximum number of iterations
+
+    returns: LowRankDiag with numpy arrays F and d, number of iterations
+    """
+    sigma = np.asarray(sigma)
+    approximation = LowRankDiag(
+        F=np.array(initial_sigma.F, dtype=float),
+        d=np.array(initial_sigma.d, dtype=float),
+    )
+
+    # stacked approximations that have not converged yet
+    active = np.ones(sigma.shape[:-2], dtype=bool)
+    iteration = 0
+
+    while iteration < max_iter and active.any():
+        iteration += 1
 
-    for _ in range(5):
-        Cxx, Cxs, Css = _e_step(sigma, F, d)
-        F, d = _m_step(Cxx, Cxs, Css)
+        old = LowRankDiag(F=approximation.F[active], d=approximation.d[active])
+        new = _m_step(*_e_step(sigma[active], old.F, old.d))
 
-    return LowRankDiag(F=pd.DataFrame(F, index=assets), d=pd.Series(d, index=assets))
+        approximation.F[active] = new.F
+        approximation.d[active] = new.d
 
+        if tol is not None:
+            active[active] = _relative_change(old, new) >= tol
 
-def em_regularize_covariance(sigmas, initial_sigmas):
+    return approximation, iteration
+
+
+def em_regularize_covariance(
+    sigmas,
+    initial_sigmas=None,
+    rank=None,
+    tol=None,
+    max_iter=5,
+    warm_start=False,
+    batch_size=1,
+):
     """
     param sigmas: dictionary of covariance matrices
     param  initial_sigmas: dictionary of initial low rank + diagonal approximations; these
-    are namedtuples with fields F and d, with F nxk and d length n
+    are namedtuples with fields F and d, with F nxk and d length n; optional
+    param rank: rank of the low rank component; only used for a time step
+    without an initial approximation and without a previous time step, which
+    starts from the factor form regularization
+    param tol: stops once the relative change of the approximation is below
+    tol; if None, runs max_iter iterations
+    param max_iter: maximum number of iterations per time step
+    param warm_start: if True, each time step starts from the approximation of
+    the previous time step even if an initial approximation is given; time
+    steps without an initial approximation always start from the previous one
+    param batch_size: number of time steps fitted at once as stacked arrays; a
+    batch starts from the last approximation of the previous batch
 
     returns: regularized covariance matrices
     """
-
-    # for time, sigma in tqdm(sigmas.items()):
-    for time, sigma in sigmas.items():
-        yield time, _em_low_rank_approximation(sigma, initial_sigmas[time])
+    initial_sigmas = initial_sigmas or {}
+    times = list(sigmas.keys())
+    previous = None
+
+    # for start in tqdm(range(0, len(times), batch_size)):
+    for start in range(0, len(times), batch_size):
+        batch = times[start : start + batch_size]
+        stacked = np.stack([np.asarray(sigmas[time], dtype=float) for time in batch])
+
+        initials = []
+        for time, sigma in zip(batch, stacked):
+            if time in initial_sigmas and (previous is None or not warm_start):
+                initials.append(initial_sigmas[time])
+            elif previous is not None:
+                initials.append(previous)
+            else:
+                assert rank is not None, "rank is required without initial_sigmas"
+                initials.append(_initial_low_rank(sigma, rank))
+
+        approximation, _ = _em_low_rank_approximation(
+            stacked,
+            LowRankDiag(
+                F=np.stack([np.asarray(initial.F) for initial in initials]),
+                d=np.stack([np.asarray(initial.d) for initial in initials]),
+            ),
+            tol=tol,
+            max_iter=max_iter,
+        )
+        previous = LowRankDiag(F=approximation.F[-1], d=approximation.d[-1])
+
+        for time, F, d in zip(batch, approximation.F, approximation.d):
+            assets = sigmas[time].columns
+            yield time, LowRankDiag(
+                F=pd.DataFrame(F, index=assets), d=pd.Series(d, index=assets)
+            )
@@ -0,0 +1,322 @@
+from __future__ import annotations
+
+import json
+import struct
+from collections.abc import Mapping
+
+import numpy as np
+import pandas as pd
+
+from .general_functions import CovarianceTensor, pack_covariances
+
+# File layout of a store:
+#   magic | header length | json header, padded to a multiple of 64 bytes
+#   T rows of raw floats, each row a packed covariance or a vector
+#   T int64 time stamps | number of rows | offset of the time stamps | end magic
+_MAGIC = b"COVSTORE"
+_END_MAGIC = b"COVSTEND"
+_FOOTER = struct.Struct("<QQ8s")
+_ALIGN = 64
+
+
+class StoreWriter:
+    def __init__(self, path, columns=None, layout="packed", dtype=np.float64):
+        """
+        Streams a time series of covariance matrices or vectors into a binary
+        store that can be opened with open_store
+
+        param path: file to write
+        param columns: assets (or labels of the vector entries); if None, they
+        are taken from the first DataFrame or Series appended, or are
+        0, ..., n-1 for a numpy array; required to append packed upper
+        triangles
+        param layout: "packed" for symmetric matrices, stored as upper
+        triangles, or "vector" for vectors, e.g. weights or means
+        param dtype: floating point type of the stored values
+        """
+        assert layout in ("packed", "vector"), "layout must be packed or vector"
+
+        self.__path = path
+        self.__columns = None if columns is None else pd.Index(columns)
+        self.__layout = layout
+        self.__dtype = np.dtype(dtype)
+        self.__times = []
+        self.__file = open(path, "wb")
+        self.__data_offset = None
+
+    @property
+    def path(self):
+        return self.__path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write_header(self):
+        header = json.dumps(
+            {
+                "version": 1,
+                "layout": self.__layout,
+                "dtype": self.__dtype.str,
+                "columns": self.__columns.tolist(),
+            }
+        ).encode()
+        offset = len(_MAGIC) + 8 + len(header)
+        header += b" " * (-offset % _ALIGN)
+
+        self.__file.write(_MAGIC)
+        self.__file.write(struct.pack("<Q", len(header)))
+        self.__file.write(header)
+        self.__data_offset = self.__file.tell()
+
+    def append(self, time, value):
+        """
+        param time: time stamp of the value
+        param value: nxn covariance matrix or its packed upper triangle (packed
+        layout), or vector of length n (vector layout), as numpy array or
+        pandas object
+        """
+        if self.__columns is None:
+            self.__columns = self._columns(value)
+        if self.__data_offset is None:
+            self._write_header()
+
+        value = np.asarray(value, dtype=self.__dtype)
+        if self.__layout == "packed" and value.ndim == 2:
+            value = pack_covariances(value)
+
+        assert value.shape == (self._width,), "value does not match the columns"
+
+        self.__file.write(np.ascontiguousarray(value).tobytes())
+        self.__times.append(time)
+
+    def _columns(self, value):
+        """
+        returns: the columns of the first value appended, a RangeIndex for
+        numpy arrays
+        """
+        if isinstance(value, pd.DataFrame):
+            return pd.Index(value.columns)
+        if isinstance(value, pd.Series):
+            return pd.Index(value.index)
+
+        value = np.asarray(value)
+        if self.__layout == "packed" and value.ndim == 1:
+            raise ValueError(
+                "the number of assets of a packed upper triangle is ambiguous, "
+                "pass columns= to StoreWriter"
+            )
+        return pd.RangeIndex(value.shape[-1])
+
+    def write(self, items):
+        """
+        param items: iterable of (time, value) pairs, e.g. dict.items()
+        """
+        for time, value in items:
+            self.append(time, value)
+        return self
+
+    @property
+    def _width(self):
+        n = len(self.__columns)
+        return n * (n + 1) // 2 if self.__layout == "packed" else n
+
+    def close(self):
+        if self.__file.closed:
+            return
+
+        if self.__data_offset is None:
+            self.__columns = self.__columns if self.__columns is not None else pd.Index([])
+            self._write_header()
+
+        times_offset = self.__file.tell()
+        self.__file.write(_times_to_array(self.__times).tobytes())
+        self.__file.write(_FOOTER.pack(len(self.__times), times_offset, _END_MAGIC))
+        self.__file.close()
+
+
+class VectorStore(Mapping):
+    def __init__(self, values, time, columns):
+        """
+        Time series of vectors backed by a (memory mapped) Txn array
+
+        param values: Txn array
+        param time: index of length T
+        param columns: index of length n
+        """
+        self.__values = values
+        self.__time = pd.Index(time)
+        self.__columns = pd.Index(columns)
+
+    @property
+    def values(self):
+        return self.__values
+
+    @property
+    def time(self):
+        return self.__time
+
+    @property
+    def columns(self):
+        return self.__columns
+
+    def __len__(self):
+        return len(self.__time)
+
+    def __iter__(self):
+        return iter(self.__time)
+
+    def __getitem__(self, key):
+        """
+        param key: a time step, returns the Series at that time; or a slice of
+        time steps (label based, as in .loc), returns a DataFrame
+        """
+        if isinstance(key, slice):
+            indexer = self.__time.slice_indexer(key.start, key.stop, key.step)
+            return pd.DataFrame(
+                np.array(self.__values[indexer]),
+                index=self.__time[indexer],
+                columns=self.__columns,
+            )
+
+        k = self.__time.get_loc(key)
+        return pd.Series(np.array(self.__values[k]), index=self.__columns, name=key)
+
+    def to_frame(self):
+        return self[:]
+
+    def __repr__(self):
+        return f"VectorStore(T={len(self)}, n={len(self.columns)})"
+
+
+def open_store(path):
+    """
+    Opens a store written by StoreWriter via memory mapping; only the pages of
+    the dates that are accessed are read from disk
+
+    returns: CovarianceTensor for the packed layout, VectorStore for vectors
+    """
+    with open(path, "rb") as file:
+        if file.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError(f"{path} is not a covariance store")
+
+        (header_length,) = struct.unpack("<Q", file.read(8))
+        header = json.loads(file.read(header_length))
+        data_offset = file.tell()
+
+        file.seek(-_FOOTER.size, 2)
+        T, times_offset, end_magic = _FOOTER.unpack(file.read(_FOOTER.size))
+        if end_magic != _END_MAGIC:
+            raise ValueError(f"{path} has not been closed by its writer")
+
+        file.seek(times_offset)
+        times = pd.DatetimeIndex(
+            np.frombuffer(file.read(8 * T), dtype="<i8").view("datetime64[ns]")
+        )
+
+    columns = pd.Index(header["columns"])
+    n = len(columns)
+    width = n * (n + 1) // 2 if header["layout"] == "packed" else n
+
+    if T * width > 0:
+        values = np.memmap(
+            path,
+            dtype=np.dtype(header["dtype"]),
+            mode="r",
+            offset=data_offset,
+            shape=(T, width),
+        )
+    else:
+        values = np.empty((T, width), dtype=np.dtype(header["dtype"]))
+
+    if header["layout"] == "packed":
+        return CovarianceTensor(values, time=times, assets=columns)
+    return VectorStore(values, time=times, columns=columns)
+
+
+def write_covariances(path, covariances, assets=None, dtype=None):
+    """
+    Streams covariance matrices into a packed store
+
+    param covariances: dictionary {time: Sigma}, CovarianceTensor, or iterable
+    of results with fields time and covariance, e.g. iterated_ewma(...) or
+    _CovarianceCombination.solve(...); None results are skipped
+    param dtype: floating point type of the store; defaults to the type of a
+    CovarianceTensor, else np.float64
+    """
+    if isinstance(covariances, CovarianceTensor):
+        assets = covariances.assets
+
+    if dtype is None:
+        # float32 tensors are stored as float32
+        dtype = (
+            covariances.packed.dtype
+            if isinstance(covariances, CovarianceTensor)
+            else np.float64
+        )
+
+    with StoreWriter(path, columns=assets, layout="packed", dtype=dtype) as writer:
+        if isinstance(covariances, CovarianceTensor):
+            # the rows are already packed
+            writer.write(zip(covariances.time, covariances.packed))
+        elif isinstance(covariances, Mapping):
+            writer.write(covariances.items())
+        else:
+            writer.write(
+                (result.time, result.covariance)
+                for result in covariances
+                if result is not None
+            )
+
+    return open_store(path)
+
+
+def write_vectors(path, vectors, columns=None, dtype=np.float64):
+    """
+    Streams vectors, e.g. combination weights or means, into a vector store
+
+    param vectors: dictionary {time: vector} or iterable of (time, vector)
+    """
+    items = vectors.items() if isinstance(vectors, Mapping) else vectors
+    with StoreWriter(path, columns=columns, layout="vector", dtype=dtype) as writer:
+        writer.write(items)
+
+    return open_store(path)
+
+
+def write_results(results, covariance_path, weights_path=None, mean_path=None):
+    """
+    Streams the results of _CovarianceCombination.solve into stores, the
+    results are consumed once
+
+    param results: iterable of Result objects; None results are skipped
+    param covariance_path: store for the covariance matrices
+    param weights_path: store for the weights of the experts (optional)
+    param mean_path: store for the means (optional)
+    """
+    writers = {"covariance": StoreWriter(covariance_path, layout="packed")}
+    if weights_path is not None:
+        writers["weights"] = StoreWriter(weights_path, layout="vector")
+    if mean_path is not None:
+        writers["mean"] = StoreWriter(mean_path, layout="vector")
+
+    try:
+        for result in results:
+            if result is None:
+                continue
+            for field, writer in writers.items():
+                writer.append(result.time, getattr(result, field))
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    return {field: open_store(writer.path) for field, writer in writers.items()}
+
+
+def _times_to_array(times):
+    """
+    Converts time stamps to int64 nanoseconds
+    """
+    return np.asarray(pd.DatetimeIndex(times), dtype="datetime64[ns]").view("<i8")
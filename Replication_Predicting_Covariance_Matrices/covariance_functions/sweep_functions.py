@@ -0,0 +1,234 @@
+from __future__ import annotations
+
+import itertools
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+
+import numpy as np
+import pandas as pd
+import scipy as sc
+
+from .backtest_functions import _squared_error, log_likelihood
+from .em_functions import from_sigmas
+from .ewma_functions import iterated_ewma_tensors
+from .general_functions import CovarianceTensor, add_to_diagonal
+from .regularization_functions import regularize_covariance
+
+Configuration = namedtuple("Configuration", ["pairs", "window", "lamda", "rank"])
+
+
+def sweep(
+    returns,
+    pair_sets,
+    windows=(10,),
+    lamdas=(0.05,),
+    ranks=(None,),
+    min_periods=63,
+    start=None,
+    backend="cvxpy",
+    processes=None,
+    **kwargs,
+):
+    """
+    Evaluates CM-IEWMA for all combinations of the given hyperparameters and
+    ranks them by their out of sample log likelihood and MSE
+
+    param returns: pandas DataFrame of returns
+    param pair_sets: list of lists of pairs of EWMA half lives, e.g.
+    [[(10, 21), (21, 63), (63, 125)], [(21, 63), (63, 125), (125, 250)]];
+    the first pair of each list is the fast expert, see lamdas
+    param windows: sizes of the combination window
+    param lamdas: diagonal loadings of the fast expert, see add_to_diagonal
+    param ranks: ranks of the factor form regularization of all experts, see
+    regularize_covariance; None for no regularization
+    param min_periods: min_periods_vola and min_periods_cov of the experts
+    param start: first time step of the evaluation (optional)
+    param backend: backend of the combination, see _CovarianceCombination.solve
+    param processes: if larger than 1, the regularizations and the
+    combinations are computed in a pool of processes
+    param kwargs: passed to _CovarianceCombination.solve
+
+    returns: DataFrame with one row per Configuration (pairs, window, lamda,
+    rank) and the mean log likelihood and MSE of its predictions for the next
+    time step, the number of time steps evaluated and the positions of the
+    configuration when ranked by log likelihood and by MSE (1 is best); sorted
+    by log likelihood
+
+    Note: all configurations are evaluated on the same time steps, those after
+    start where all of them have a prediction. Each expert is computed once
+    for all configurations: the IEWMA of all distinct pairs in a single sweep
+    over the returns, each regularization once per pair and rank; the
+    Cholesky factors of a combination are shared by all its windows
+    """
+    pair_sets = [[tuple(pair) for pair in pair_set] for pair_set in pair_sets]
+    pairs = list(dict.fromkeys(pair for pairs in pair_sets for pair in pairs))
+
+    tensors = iterated_ewma_tensors(
+        returns,
+        pairs,
+        min_periods_vola=min_periods,
+        min_periods_cov=min_periods,
+        packed=True,
+    )
+    experts = {(pair, None): tensors[_key(pair)].covariance for pair in pairs}
+    del tensors
+
+    with _executor(processes) as executor:
+        regularized = [(pair, rank) for pair in pairs for rank in ranks if rank]
+        for key, expert in zip(
+            regularized,
+            _map(
+                executor,
+                _regularize,
+                [(experts[(pair, None)], rank) for pair, rank in regularized],
+            ),
+        ):
+            experts[key] = expert
+
+        # one task per combination, shared by all its windows
+        tasks = [
+            dict(
+                sigmas={
+                    _key(pair): experts[(pair, rank)] for pair in pair_set
+                },
+                fast=_key(pair_set[0]),
+                lamda=lamda,
+                returns=returns,
+                windows=list(windows),
+                backend=backend,
+                kwargs=kwargs,
+            )
+            for pair_set, lamda, rank in itertools.product(pair_sets, lamdas, ranks)
+        ]
+        scores = list(_map(executor, _evaluate_combination, tasks))
+
+    configurations = [
+        Configuration(pairs=tuple(pair_set), window=window, lamda=lamda, rank=rank)
+        for pair_set, lamda, rank in itertools.product(pair_sets, lamdas, ranks)
+        for window in windows
+    ]
+    scores = [score for task_scores in scores for score in task_scores]
+
+    # the time steps where all configurations have a prediction
+    times = scores[0].index
+    for score in scores[1:]:
+        times = times.intersection(score.index)
+    if start is not None:
+        times = times[times >= start]
+
+    table = pd.DataFrame(
+        [
+            {
+                "log_likelihood": score.loc[times, "log_likelihood"].mean(),
+                "mse": score.loc[times, "mse"].mean(),
+                "dates": len(times),
+            }
+            for score in scores
+        ],
+        index=pd.MultiIndex.from_tuples(
+            [
+                (_label(c.pairs), c.window, c.lamda, c.rank)
+                for c in configurations
+            ],
+            names=list(Configuration._fields),
+        ),
+    )
+    table["by_log_likelihood"] = (
+        table["log_likelihood"].rank(ascending=False, method="min").astype(int)
+    )
+    table["by_mse"] = table["mse"].rank(method="min").astype(int)
+
+    return table.sort_values("log_likelihood", ascending=False)
+
+
+def _evaluate_combination(task):
+    """
+    Solves one combination for all windows of the task
+
+    returns: list of DataFrames, one per window, with the log likelihood and
+    the MSE of each prediction, indexed by the time of the realized returns
+    """
+    sigmas = dict(task["sigmas"])
+    returns = task["returns"]
+
+    if task["lamda"]:
+        sigmas[task["fast"]] = add_to_diagonal(sigmas[task["fast"]], lamda=task["lamda"])
+
+    combination = from_sigmas(sigmas, returns)
+
+    scores = []
+    for window in task["windows"]:
+        results = [
+            result
+            for result in combination.solve(
+                window=window, backend=task["backend"], **task["kwargs"]
+            )
+            if result is not None
+        ]
+        scores.append(_score(returns, results))
+
+    return scores
+
+
+def _score(returns, results, chunk_size=256):
+    """
+    Log likelihood and MSE of each prediction for the next time step
+    """
+    times = pd.Index([result.time for result in results])
+    positions = returns.index.get_indexer(times)
+    keep = positions + 1 < len(returns)
+    results = [result for result, k in zip(results, keep) if k]
+    positions = positions[keep]
+
+    realized = returns.values[positions + 1]
+    Ls = np.stack([result.L for result in results])
+
+    mse = np.empty(len(results))
+    for start in range(0, len(results), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        # the MSE needs Sigma, the inverse of L L^T
+        identity = np.broadcast_to(np.eye(Ls.shape[-1]), Ls[chunk].shape)
+        Ls_inv = sc.linalg.solve_triangular(
+            Ls[chunk], identity, lower=True, check_finite=False
+        )
+        mse[chunk] = _squared_error(
+            realized[chunk], np.swapaxes(Ls_inv, 1, 2) @ Ls_inv
+        )
+
+    return pd.DataFrame(
+        {
+            "log_likelihood": log_likelihood(realized, precision_factors=Ls),
+            "mse": mse,
+        },
+        index=returns.index[positions + 1],
+    )
+
+
+def _regularize(args):
+    sigmas, rank = args
+    return CovarianceTensor.from_dict(dict(regularize_covariance(sigmas, r=rank)))
+
+
+def _key(pair):
+    return f"{pair[0]}-{pair[1]}"
+
+
+def _label(pairs):
+    return ", ".join(_key(pair) for pair in pairs)
+
+
+def _executor(processes):
+    """
+    returns: a pool of processes, or a context without executor (None) for
+    processes <= 1
+    """
+    if not processes or processes <= 1:
+        return nullcontext()
+    return ProcessPoolExecutor(max_workers=processes)
+
+
+def _map(executor, function, items):
+    if executor is None:
+        return map(function, items)
+    return executor.map(function, items)
@@ -0,0 +1,95 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from covariance_functions import backtest_functions as bf  # noqa: E402
+from covariance_functions.em_functions import Result  # noqa: E402
+
+
+def _covariances(T=6, n=5, seed=0):
+    rng = np.random.default_rng(seed)
+    A = rng.standard_normal((T, n, n))
+    return A @ np.swapaxes(A, 1, 2) + n * np.eye(n)
+
+
+def _precision_factors(Sigmas):
+    return bf._PrecisionFactors(L=np.linalg.cholesky(np.linalg.inv(Sigmas)))
+
+
+@pytest.mark.parametrize(
+    "function",
+    [
+        bf._multiply_stacked,
+        bf._solve_stacked,
+        bf._quad_form,
+    ],
+)
+def test_precision_factors_vector_paths_match_dense(function):
+    Sigmas = _covariances()
+    w = np.random.default_rng(1).standard_normal(Sigmas.shape[:2])
+
+    np.testing.assert_allclose(
+        function(_precision_factors(Sigmas), w), function(Sigmas, w), rtol=1e-10
+    )
+
+
+@pytest.mark.parametrize(
+    "function", [bf._min_variance_weights, bf._risk_parity_weights]
+)
+def test_precision_factors_weights_match_dense(function):
+    Sigmas = _covariances()
+
+    np.testing.assert_allclose(
+        function(_precision_factors(Sigmas)), function(Sigmas), rtol=1e-8
+    )
+
+
+def test_portfolio_backtest_results_match_dense():
+    T, n = 40, 5
+    times = pd.bdate_range("2020-01-01", periods=T)
+    assets = pd.Index([f"a{i}" for i in range(n)])
+    returns = pd.DataFrame(
+        np.random.default_rng(2).standard_normal((T, n)) * 0.01,
+        index=times,
+        columns=assets,
+    )
+    Sigmas = _covariances(T, n) * 1e-4
+    Ls = _precision_factors(Sigmas).L
+
+    dense = {
+        time: pd.DataFrame(Sigma, index=assets, columns=assets)
+        for time, Sigma in zip(times, Sigmas)
+    }
+    results = [
+        Result(
+            time=time,
+            L=L,
+            nu=np.zeros(n),
+            weights=pd.Series([1.0], index=["expert"]),
+            assets=assets,
+            status="optimal",
+            iterations=None,
+        )
+        for time, L in zip(times, Ls)
+    ]
+
+    backtest = bf.portfolio_backtest(
+        returns, {"dense": dense, "results": results}, chunk_size=16
+    )
+
+    for strategy in ("min_variance", "risk_parity", "vol_target"):
+        np.testing.assert_allclose(
+            backtest.weights[("results", strategy)].values,
+            backtest.weights[("dense", strategy)].values,
+            rtol=1e-8,
+        )
+    np.testing.assert_allclose(
+        backtest.predicted_volatility["results"].values,
+        backtest.predicted_volatility["dense"].values,
+        rtol=1e-8,
+    )
@@ -0,0 +1,52 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from covariance_functions.cache_functions import ResultCache  # noqa: E402
+from covariance_functions.ewma_functions import iterated_ewma_tensor  # noqa: E402
+
+
+def _returns(T=120, n=4, seed=0):
+    return pd.DataFrame(
+        np.random.default_rng(seed).standard_normal((T, n)) * 0.01,
+        index=pd.bdate_range("2020-01-01", periods=T),
+        columns=[f"a{i}" for i in range(n)],
+    )
+
+
+def test_default_arguments_share_the_cache_entry(tmp_path):
+    returns = _returns()
+    cache = ResultCache(tmp_path)
+
+    default = cache.iterated_ewma_tensor(returns, 10, 21)
+    explicit = cache.iterated_ewma_tensor(returns, 10, 21, times=None, packed=True)
+
+    assert len(os.listdir(tmp_path)) == 1
+    np.testing.assert_array_equal(
+        explicit.covariance.packed, default.covariance.packed
+    )
+    np.testing.assert_allclose(
+        default.covariance.packed,
+        iterated_ewma_tensor(returns, 10, 21, packed=True).covariance.packed,
+        rtol=1e-12,
+    )
+
+
+def test_requested_times_are_cached_separately(tmp_path):
+    returns = _returns()
+    cache = ResultCache(tmp_path)
+    times = returns.index[[50, -1]]
+
+    cache.iterated_ewma_tensor(returns, 10, 21)
+    requested = cache.iterated_ewma_tensor(returns, 10, 21, times=times)
+
+    assert len(os.listdir(tmp_path)) == 2
+    assert list(requested.time) == list(times)
+    expected = iterated_ewma_tensor(returns, 10, 21, packed=True, times=times)
+    np.testing.assert_allclose(
+        requested.covariance.packed, expected.covariance.packed, rtol=1e-12
+    )
@@ -0,0 +1,125 @@
+import os
+import sys
+
+import cvxpy as cvx
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from covariance_functions.em_functions import (  # noqa: E402
+    _cholesky_precision,
+    from_sigmas,
+)
+from covariance_functions.general_functions import CovarianceTensor  # noqa: E402
+
+WINDOW = 5
+
+
+def _covariances(T, n, rng):
+    A = rng.standard_normal((T, n, n)) * 0.01
+    return A @ np.swapaxes(A, 1, 2) + 1e-4 * np.eye(n)
+
+
+def _problem(T=25, n=3, seed=0):
+    rng = np.random.default_rng(seed)
+    times = pd.bdate_range("2020-01-01", periods=T)
+    assets = [f"a{i}" for i in range(n)]
+    returns = pd.DataFrame(
+        rng.standard_normal((T, n)) * 0.01, index=times, columns=assets
+    )
+    sigmas = {
+        key: {
+            time: pd.DataFrame(Sigma, index=assets, columns=assets)
+            for time, Sigma in zip(times, _covariances(T, n, rng))
+        }
+        for key in ["slow", "medium", "fast"]
+    }
+    return sigmas, returns
+
+
+def _reference_weights(sigmas, returns, window):
+    """
+    Weights of the combination problem at each time step, with A and P formed
+    from scratch from the precision factors of the previous time steps
+    """
+    times = returns.index
+    Ls = {
+        key: {
+            time: np.linalg.cholesky(np.linalg.inv(sigma.values))
+            for time, sigma in sigma_key.items()
+        }
+        for key, sigma_key in sigmas.items()
+    }
+
+    weights = {}
+    for t in range(window, len(times)):
+        A, P = [], 0
+        for s in range(t - window + 1, t + 1):
+            L = [Ls[key][times[s - 1]] for key in sigmas]
+            B = np.column_stack([L_k.T @ returns.values[s] for L_k in L])
+            P = P + B.T @ B
+            A.append(np.column_stack([np.diag(L_k) for L_k in L]))
+        A = np.vstack(A)
+
+        w = cvx.Variable(len(sigmas))
+        cvx.Problem(
+            cvx.Maximize(cvx.sum(cvx.log(A @ w)) - 0.5 * cvx.quad_form(w, P)),
+            [cvx.sum(w) == 1, w >= 0],
+        ).solve()
+        weights[times[t]] = w.value
+
+    return pd.DataFrame(weights).T
+
+
+def _weights(results):
+    return pd.DataFrame({result.time: result.weights.values for result in results}).T
+
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_cholesky_precision_matches_reference(packed):
+    rng = np.random.default_rng(0)
+    times = pd.bdate_range("2020-01-01", periods=7)
+    Sigmas = _covariances(7, 4, rng)
+    # not positive definite
+    Sigmas[3] = -np.eye(4)
+    sigmas = {time: pd.DataFrame(Sigma) for time, Sigma in zip(times, Sigmas)}
+    if packed:
+        sigmas = CovarianceTensor.from_dense(Sigmas, time=times, assets=range(4))
+
+    Ls, failed = _cholesky_precision(sigmas, chunk_size=3)
+
+    assert list(failed.index[failed.values]) == [times[3]]
+    assert list(Ls) == [time for time in times if time != times[3]]
+    for time, Sigma in zip(times, Sigmas):
+        if time != times[3]:
+            np.testing.assert_allclose(
+                Ls[time], np.linalg.cholesky(np.linalg.inv(Sigma)), rtol=1e-10
+            )
+
+
+def test_combination_weights_match_reference():
+    sigmas, returns = _problem()
+    expected = _reference_weights(sigmas, returns, WINDOW)
+    combination = from_sigmas(sigmas, returns)
+
+    cvxpy = _weights(combination.solve(window=WINDOW))
+    newton = _weights(combination.solve(window=WINDOW, backend="newton"))
+
+    pd.testing.assert_index_equal(cvxpy.index, expected.index)
+    # both are solved within the tolerance of the conic solver
+    np.testing.assert_allclose(cvxpy.values, expected.values, atol=1e-4)
+    # the barrier method stops within its tolerance of the conic solution
+    np.testing.assert_allclose(newton.values, expected.values, atol=5e-4)
+
+
+def test_parallel_solve_matches_serial():
+    sigmas, returns = _problem()
+    combination = from_sigmas(sigmas, returns)
+
+    serial = _weights(combination.solve(window=WINDOW))
+    parallel = _weights(combination.solve(window=WINDOW, processes=2, chunk_size=4))
+
+    # each chunk starts the conic solver cold
+    pd.testing.assert_frame_equal(parallel, serial, atol=1e-4)
@@ -0,0 +1,129 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from covariance_functions.ewma_functions import (  # noqa: E402
+    IteratedEWMAState,
+    iterated_ewma,
+    iterated_ewma_tensor,
+    iterated_ewma_tensors,
+)
+
+MIN_PERIODS = dict(min_periods_vola=5, min_periods_cov=10)
+
+
+def _returns(T=80, n=4, seed=0):
+    returns = pd.DataFrame(
+        np.random.default_rng(seed).standard_normal((T, n)) * 0.01,
+        index=pd.bdate_range("2020-01-01", periods=T),
+        columns=[f"a{i}" for i in range(n)],
+    )
+    returns.iloc[30, 1] = np.nan
+    return returns
+
+
+def _ewma(x, halflife):
+    """
+    EWMA of the rows of x as weighted averages, weight beta^(t-s) for row s
+    at row t
+    """
+    beta = np.exp(-np.log(2) / halflife)
+    T = len(x)
+    weights = np.tril(beta ** np.subtract.outer(np.arange(T), np.arange(T)))
+    weights /= weights.sum(axis=1, keepdims=True)
+    return np.tensordot(weights, x, axes=1)
+
+
+def _reference(returns, vola_halflife, cov_halflife, min_periods_vola, min_periods_cov):
+    """
+    returns: times, covariances and volatilities of the iterated EWMA without
+    mean adjustment or clipping
+    """
+    y = returns.fillna(0.0).values
+    vola = np.sqrt(_ewma(y**2, vola_halflife))[min_periods_vola - 1 :]
+    adj = y[min_periods_vola - 1 :] / vola
+
+    cov = _ewma(adj[:, :, None] * adj[:, None, :], cov_halflife)
+    std = np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+    corr = cov / (std[:, :, None] * std[:, None, :])
+
+    first = min_periods_cov - 1
+    vola = vola[first:]
+    return (
+        returns.index[min_periods_vola - 1 :][first:],
+        corr[first:] * vola[:, :, None] * vola[:, None, :],
+        vola,
+    )
+
+
+def test_iterated_ewma_tensor_matches_reference():
+    returns = _returns()
+    times, covariances, volas = _reference(returns, 10, 21, **MIN_PERIODS)
+
+    tensor = iterated_ewma_tensor(returns, 10, 21, **MIN_PERIODS)
+
+    assert list(tensor.time) == list(times)
+    np.testing.assert_allclose(tensor.covariance, covariances, rtol=1e-12)
+    np.testing.assert_allclose(tensor.volatility, volas, rtol=1e-12)
+
+    packed = iterated_ewma_tensor(returns, 10, 21, packed=True, **MIN_PERIODS)
+    np.testing.assert_allclose(packed.covariance.dense(), covariances, rtol=1e-12)
+
+
+def test_iterated_ewma_matches_reference():
+    returns = _returns()
+    times, covariances, _ = _reference(returns, 10, 21, **MIN_PERIODS)
+
+    results = list(iterated_ewma(returns, 10, 21, **MIN_PERIODS))
+
+    assert [result.time for result in results] == list(times)
+    np.testing.assert_allclose(
+        np.stack([result.covariance.values for result in results]),
+        covariances,
+        rtol=1e-12,
+    )
+
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_iterated_ewma_tensors_match_reference(packed):
+    returns = _returns()
+    pairs = [(10, 21), (10, 42), (21, 63)]
+
+    tensors = iterated_ewma_tensors(returns, pairs, packed=packed, **MIN_PERIODS)
+
+    for pair in pairs:
+        times, covariances, _ = _reference(returns, *pair, **MIN_PERIODS)
+        tensor = tensors[f"{pair[0]}-{pair[1]}"]
+        covariance = tensor.covariance.dense() if packed else tensor.covariance
+
+        assert list(tensor.time) == list(times)
+        np.testing.assert_allclose(covariance, covariances, rtol=1e-12)
+
+
+def test_iterated_ewma_state_matches_reference():
+    returns = _returns()
+    times, covariances, volas = _reference(returns, 10, 21, **MIN_PERIODS)
+
+    state = IteratedEWMAState(returns.columns, 10, 21, **MIN_PERIODS)
+    estimates = [state.update(row) for _, row in returns.iterrows()]
+    estimates = [estimate for estimate in estimates if estimate is not None]
+
+    assert [estimate.time for estimate in estimates] == list(times)
+    np.testing.assert_allclose(
+        np.stack([estimate.covariance.values for estimate in estimates]),
+        covariances,
+        rtol=1e-12,
+    )
+    np.testing.assert_allclose(
+        np.stack([estimate.volatility.values for estimate in estimates]),
+        volas,
+        rtol=1e-12,
+    )
+
+    last = IteratedEWMAState.from_returns(returns, 10, 21, **MIN_PERIODS).estimate
+    np.testing.assert_allclose(last.covariance.values, covariances[-1], rtol=1e-12)
@@ -0,0 +1,61 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from covariance_functions.factor_functions import factor_covariance  # noqa: E402
+
+
+def _returns(T=800, n=6, k=3, seed=0):
+    rng = np.random.default_rng(seed)
+    times = pd.bdate_range("2000-01-03", periods=T)
+    factors = pd.DataFrame(
+        rng.standard_normal((T, k)) * 0.01,
+        index=times,
+        columns=[f"f{i}" for i in range(k)],
+    )
+    returns = pd.DataFrame(
+        factors.values @ rng.standard_normal((k, n))
+        + 0.01 * rng.standard_normal((T, n)),
+        index=times,
+        columns=[f"a{i}" for i in range(n)],
+    )
+    return returns, factors
+
+
+def test_delisted_asset_leaves_the_universe():
+    returns, factors = _returns()
+    # a0 delisted at row 400, a1 without returns for 50 days
+    returns.iloc[400:, 0] = np.nan
+    returns.iloc[300:350, 1] = np.nan
+
+    estimates = dict(factor_covariance(returns, factors))
+
+    assert "a0" in estimates[returns.index[399]].F.index
+    for time in returns.index[400:]:
+        assert "a0" not in estimates[time].F.index
+        assert "a0" not in estimates[time].d.index
+        assert "a1" in estimates[time].F.index
+
+
+def test_loadings_match_weighted_least_squares():
+    returns, factors = _returns()
+    returns.iloc[:100, 2] = np.nan
+
+    time, estimate = list(factor_covariance(returns, factors, factor_halflife=63))[-1]
+
+    beta = 1 - (1 - np.exp(-np.log(2) / 125))
+    w = beta ** np.arange(len(returns) - 1, -1, -1)[100:]
+    f = factors.values[100:]
+    r = returns.values[100:, 2]
+    B = np.linalg.solve((f * w[:, None]).T @ f, (f * w[:, None]).T @ r)
+
+    beta = 1 - (1 - np.exp(-np.log(2) / 63))
+    w = beta ** np.arange(len(returns) - 1, -1, -1)
+    Sigma_f = (factors.values * w[:, None]).T @ factors.values / w.sum()
+
+    F = estimate.F.loc["a2"].values
+    np.testing.assert_allclose(F @ F, B @ Sigma_f @ B, rtol=1e-10)
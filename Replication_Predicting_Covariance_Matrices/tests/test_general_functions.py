@@ -0,0 +1,57 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from covariance_functions.general_functions import (  # noqa: E402
+    CovarianceTensor,
+    add_to_diagonal,
+)
+
+
+def _tensor(T=4, n=3, seed=0):
+    A = np.random.default_rng(seed).standard_normal((T, n, n))
+    return CovarianceTensor.from_dense(
+        A @ np.swapaxes(A, 1, 2) + n * np.eye(n),
+        time=pd.bdate_range("2020-01-01", periods=T),
+        assets=[f"a{i}" for i in range(n)],
+    )
+
+
+def test_add_to_diagonal_leaves_the_tensor_unchanged(tmp_path):
+    tensor = _tensor()
+    dense = tensor.dense()
+
+    # read-only memmap of the packed triangles, as written by the cache
+    path = tmp_path / "packed.npy"
+    np.save(path, tensor.packed)
+    mapped = CovarianceTensor(
+        np.load(path, mmap_mode="r"), time=tensor.time, assets=tensor.assets
+    )
+    view = mapped.take([1, 2])
+
+    loaded = add_to_diagonal(mapped, lamda=0.5)
+
+    np.testing.assert_array_equal(mapped.dense(), dense)
+    np.testing.assert_array_equal(view.dense(), dense[1:3])
+    np.testing.assert_allclose(
+        loaded.dense(), dense + 0.5 * dense * np.eye(tensor.n)
+    )
+
+
+def test_add_to_diagonal_of_a_dictionary_matches_the_tensor():
+    tensor = _tensor()
+    sigmas = dict(tensor)
+    time = tensor.time[0]
+    first = sigmas[time]
+
+    loaded = add_to_diagonal(sigmas, lamda=0.5)
+
+    assert sigmas[time] is first
+    np.testing.assert_allclose(
+        np.stack([loaded[key].values for key in tensor.time]),
+        add_to_diagonal(tensor, lamda=0.5).dense(),
+    )
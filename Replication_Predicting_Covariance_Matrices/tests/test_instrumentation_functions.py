@@ -0,0 +1,47 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from covariance_functions.em_functions import from_sigmas  # noqa: E402
+from covariance_functions.instrumentation_functions import recording  # noqa: E402
+
+
+def _combination(T=60, n=3, seed=0):
+    rng = np.random.default_rng(seed)
+    times = pd.bdate_range("2020-01-01", periods=T)
+    assets = [f"a{i}" for i in range(n)]
+    returns = pd.DataFrame(
+        rng.standard_normal((T, n)) * 0.01, index=times, columns=assets
+    )
+
+    sigmas = {}
+    for key in ["slow", "fast"]:
+        A = rng.standard_normal((T, n, n)) * 0.01
+        sigmas[key] = {
+            time: pd.DataFrame(Sigma, index=assets, columns=assets)
+            for time, Sigma in zip(times, A @ np.swapaxes(A, 1, 2) + 1e-4 * np.eye(n))
+        }
+
+    return from_sigmas(sigmas, returns)
+
+
+def test_worker_events_are_recorded():
+    combination = _combination()
+
+    with recording() as serial:
+        list(combination.solve(window=5, backend="newton"))
+    with recording() as parallel:
+        list(
+            combination.solve(window=5, backend="newton", processes=2, chunk_size=10)
+        )
+
+    # the number of iterations differs at the cold start of each chunk
+    columns = ["time", "backend", "status"]
+    pd.testing.assert_frame_equal(
+        parallel.events("solve")[columns], serial.events("solve")[columns]
+    )
+    assert set(parallel.stages().index) == set(serial.stages().index)
@@ -0,0 +1,55 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from covariance_functions.regularization_functions import (  # noqa: E402
+    em_regularize_covariance,
+    regularize_covariance,
+)
+
+
+def _sigmas(T=12, n=6, seed=0):
+    rng = np.random.default_rng(seed)
+    assets = [f"a{i}" for i in range(n)]
+    A = rng.standard_normal((T, n, 2 * n))
+    Sigmas = A @ np.swapaxes(A, 1, 2) / (2 * n)
+    return {
+        time: pd.DataFrame(Sigma, index=assets, columns=assets)
+        for time, Sigma in zip(pd.bdate_range("2020-01-01", periods=T), Sigmas)
+    }
+
+
+def _em_reference(Sigma, F, d, iterations=5):
+    """
+    The EM iterations of the low rank + diagonal fit, one matrix at a time
+    """
+    for _ in range(iterations):
+        G = np.linalg.inv((F.T / d) @ F + np.eye(F.shape[1]))
+        L = G @ F.T / d
+        Cxs = Sigma @ L.T
+        Css = L @ Sigma @ L.T + G
+        F = Cxs @ np.linalg.inv(Css)
+        d = np.diag(Sigma) - 2 * np.sum(Cxs * F, axis=1) + np.sum(F * (F @ Css), axis=1)
+    return F @ F.T + np.diag(d)
+
+
+@pytest.mark.parametrize("batch_size", [1, 5])
+def test_em_regularize_covariance_matches_reference(batch_size):
+    sigmas = _sigmas()
+    initial = dict(regularize_covariance(sigmas, r=2, low_rank_format=True))
+
+    fitted = dict(
+        em_regularize_covariance(sigmas, initial_sigmas=initial, batch_size=batch_size)
+    )
+
+    for time, sigma in sigmas.items():
+        expected = _em_reference(
+            sigma.values, initial[time].F.values, initial[time].d.values
+        )
+        F, d = fitted[time].F.values, fitted[time].d.values
+        np.testing.assert_allclose(F @ F.T + np.diag(d), expected, rtol=1e-10)
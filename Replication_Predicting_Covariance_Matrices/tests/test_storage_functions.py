@@ -0,0 +1,36 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from covariance_functions.general_functions import pack_covariances  # noqa: E402
+from covariance_functions.storage_functions import (  # noqa: E402
+    StoreWriter,
+    open_store,
+)
+
+
+def test_numpy_arrays_without_columns(tmp_path):
+    times = pd.bdate_range("2020-01-01", periods=3)
+    A = np.random.default_rng(0).standard_normal((3, 4, 4))
+    Sigmas = A @ np.swapaxes(A, 1, 2)
+
+    with StoreWriter(tmp_path / "covariances") as writer:
+        writer.write(zip(times, Sigmas))
+    with StoreWriter(tmp_path / "vectors", layout="vector") as writer:
+        writer.write(zip(times, Sigmas[:, 0]))
+
+    tensor = open_store(tmp_path / "covariances")
+    vectors = open_store(tmp_path / "vectors")
+
+    assert list(tensor.assets) == [0, 1, 2, 3]
+    np.testing.assert_array_equal(tensor.dense(), Sigmas)
+    np.testing.assert_array_equal(vectors.values, Sigmas[:, 0])
+
+    with StoreWriter(tmp_path / "packed") as writer:
+        with pytest.raises(ValueError, match="columns="):
+            writer.append(times[0], pack_covariances(Sigmas[0]))
@@ -0,0 +1,49 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from covariance_functions.em_functions import Result  # noqa: E402
+from covariance_functions.sweep_functions import _score  # noqa: E402
+
+
+def test_score_matches_dense_covariances():
+    T, n = 30, 4
+    rng = np.random.default_rng(0)
+    A = rng.standard_normal((T, n, n))
+    Sigmas = A @ np.swapaxes(A, 1, 2) + n * np.eye(n)
+    Ls = np.linalg.cholesky(np.linalg.inv(Sigmas))
+    returns = pd.DataFrame(
+        rng.standard_normal((T, n)), index=pd.bdate_range("2020-01-01", periods=T)
+    )
+    results = [
+        Result(
+            time=time,
+            L=L,
+            nu=np.zeros(n),
+            weights=None,
+            assets=returns.columns,
+            status="optimal",
+            iterations=None,
+        )
+        for time, L in zip(returns.index, Ls)
+    ]
+
+    scores = _score(returns, results, chunk_size=7)
+
+    x = returns.values[1:]
+    _, logdets = np.linalg.slogdet(Sigmas[:-1])
+    quad_forms = np.sum(x * np.linalg.solve(Sigmas[:-1], x[..., None])[..., 0], axis=1)
+    np.testing.assert_allclose(
+        scores["mse"].values,
+        np.sum((Sigmas[:-1] - x[:, :, None] * x[:, None, :]) ** 2, axis=(1, 2)),
+        rtol=1e-10,
+    )
+    np.testing.assert_allclose(
+        scores["log_likelihood"].values,
+        -1 / 2 * (logdets + quad_forms) - n / 2 * np.log(2 * np.pi),
+        rtol=1e-10,
+    )